@@ -0,0 +1,101 @@
+import os
+import time
+import importlib.util
+import sys, getopt
+import torch
+import torch.nn.functional as F
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(path):
+    # the mp folders are plain scripts, import one by path with its own folder first on sys.path
+    sys.path.insert(0, os.path.join(root, os.path.dirname(path)))
+    spec = importlib.util.spec_from_file_location(path.replace('/', '_')[:-3], os.path.join(root, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def models():
+    # name -> (model constructor, input shape, number of classes / embedding size), shared by every bench script
+    return {'net': (lambda: load_script('mp3/sol.py').Net(), (3, 32, 32), 10),
+            'resnet': (lambda: load_script('mp4/sol.py').ResNet(), (3, 32, 32), 100),
+            'resnet_mp5': (lambda: load_script('mp5/sol.py').ResNet(), (3, 32, 32), 100),
+            'resnet101': (lambda: load_script('mp5/model.py').build_embedder(None, pretrained = False), (3, 224, 224), 4096)}
+
+
+def step_time(net, inputs, targets, amp_dtype, train, steps):
+    optimizer = torch.optim.SGD(net.parameters(), lr = 0.001, momentum = 0.9)
+    net.train(train)
+    for i in range(steps + 1):
+        if i == 1:
+            # the first step is warm-up
+            time1 = time.time()
+        with torch.set_grad_enabled(train), torch.autocast('cpu', dtype = amp_dtype, enabled = amp_dtype is not None):
+            outputs = net(inputs)
+        if train:
+            optimizer.zero_grad()
+            loss = F.cross_entropy(outputs.float(), targets)
+            loss.backward()
+            optimizer.step()
+    return (time.time() - time1) / steps
+
+
+def compare(name, batch_size, steps, amp_dtype):
+    '''
+    speed of amp against fp32, and how far the amp outputs drift from the fp32 outputs of the same
+    randomly initialised model: a numerical check of the reduced precision, not a model accuracy
+    '''
+    build, shape, classes = models()[name]
+    torch.manual_seed(0)
+    net = build()
+    inputs = torch.randn(batch_size, *shape)
+    targets = torch.randint(0, classes, (batch_size,))
+    # output agreement on the same weights and inputs, eval mode
+    net.eval()
+    with torch.no_grad():
+        reference = net(inputs).float()
+        with torch.autocast('cpu', dtype = amp_dtype):
+            reduced = net(inputs).float()
+    result = {'model': name, 'batch_size': batch_size,
+              'output_top1_agreement': (reference.argmax(1) == reduced.argmax(1)).float().mean().item(),
+              'output_cosine': F.cosine_similarity(reference, reduced).mean().item(),
+              'output_max_abs_diff': (reference - reduced).abs().max().item()}
+    for mode, train in (('train', True), ('infer', False)):
+        fp32 = step_time(net, inputs, targets, None, train, steps)
+        amp = step_time(net, inputs, targets, amp_dtype, train, steps)
+        result[mode + '_fp32_img_s'] = batch_size / fp32
+        result[mode + '_amp_img_s'] = batch_size / amp
+        result[mode + '_speedup'] = fp32 / amp
+    return result
+
+
+def main(argv):
+    names = ['net', 'resnet', 'resnet101']
+    batch_size = {'net': 100, 'resnet': 128, 'resnet101': 16}
+    steps = 10
+    amp = 'bf16'
+    try:
+        opts, args = getopt.getopt(argv, "", ["models=", "batch_size=", "steps=", "amp="])
+    except getopt.GetoptError:
+        print('amp.py --models=net,resnet,resnet101 --batch_size=N --steps=10 --amp=bf16|fp16')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--models":
+            names = arg.split(',')
+        elif opt == "--batch_size":
+            batch_size = dict((name, int(arg)) for name in batch_size)
+        elif opt == "--steps":
+            steps = int(arg)
+        elif opt == "--amp":
+            amp = arg
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[amp]
+    print('threads', torch.get_num_threads(), 'amp', amp)
+    for name in names:
+        result = compare(name, batch_size[name], steps, amp_dtype)
+        print(' '.join('%s=%s' % (k, '%.4g' % v if isinstance(v, float) else v) for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
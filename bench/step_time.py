@@ -0,0 +1,66 @@
+import time
+import sys, getopt
+import torch
+import torch.nn.functional as F
+from amp import load_script, models
+
+
+def step_time(name, batch_size, steps, channels_last, compile):
+    '''
+    seconds per training step (forward, loss, backward, optimizer) after warm-up,
+    plus the warm-up itself, which holds the compilation time
+    '''
+    build, shape, classes = models()[name]
+    torch.manual_seed(0)
+    net = build()
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    net.to(memory_format = memory_format)
+    model = load_script('mp5/model.py').compile_model(net, compile)
+    optimizer = torch.optim.SGD(net.parameters(), lr = 0.001, momentum = 0.9)
+    inputs = torch.randn(batch_size, *shape).to(memory_format = memory_format)
+    targets = torch.randint(0, classes, (batch_size,))
+    net.train()
+    time1 = time.time()
+    for i in range(steps + 2):
+        if i == 2:
+            # two warm-up steps: compilation, then the first optimizer state
+            warmup = time.time() - time1
+            time1 = time.time()
+        optimizer.zero_grad()
+        loss = F.cross_entropy(model(inputs), targets)
+        loss.backward()
+        optimizer.step()
+    return (time.time() - time1) / steps, warmup
+
+
+def main(argv):
+    names = ['net', 'resnet', 'resnet_mp5', 'resnet101']
+    batch_size = {'net': 100, 'resnet': 128, 'resnet_mp5': 64, 'resnet101': 16}
+    modes = ['eager', 'channels_last', 'compile', 'channels_last+compile']
+    steps = 10
+    try:
+        opts, args = getopt.getopt(argv, "", ["models=", "modes=", "batch_size=", "steps="])
+    except getopt.GetoptError:
+        print('step_time.py --models=net,resnet,resnet_mp5,resnet101 --modes=eager,channels_last,compile --batch_size=N --steps=10')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--models":
+            names = arg.split(',')
+        elif opt == "--modes":
+            modes = arg.split(',')
+        elif opt == "--batch_size":
+            batch_size = dict((name, int(arg)) for name in batch_size)
+        elif opt == "--steps":
+            steps = int(arg)
+    print('threads', torch.get_num_threads())
+    for name in names:
+        eager = None
+        for mode in modes:
+            seconds, warmup = step_time(name, batch_size[name], steps, 'channels_last' in mode, 'compile' in mode)
+            eager = eager or seconds
+            print('model=%s mode=%s batch_size=%d step_ms=%.1f img_s=%.1f speedup=%.3g warmup_s=%.1f'
+                  % (name, mode, batch_size[name], seconds * 1000, batch_size[name] / seconds, eager / seconds, warmup))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+import sys, getopt
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from PIL import Image
+from amp import load_script, root, models
+
+
+def bench_model(name, batch_size, steps):
+    '''
+    forward, backward and optimizer step of one training step, timed separately on synthetic input
+    '''
+    build, shape, classes = models()[name]
+    torch.manual_seed(0)
+    net = build()
+    net.train()
+    optimizer = torch.optim.SGD(net.parameters(), lr = 0.001, momentum = 0.9)
+    inputs = torch.randn(batch_size, *shape)
+    targets = torch.randint(0, classes, (batch_size,))
+    times = {'forward': 0.0, 'backward': 0.0, 'step': 0.0}
+    for i in range(steps + 1):
+        time1 = time.time()
+        optimizer.zero_grad()
+        loss = F.cross_entropy(net(inputs), targets)
+        time2 = time.time()
+        loss.backward()
+        time3 = time.time()
+        optimizer.step()
+        time4 = time.time()
+        if i:
+            # the first step is warm-up
+            times['forward'] += time2 - time1
+            times['backward'] += time3 - time2
+            times['step'] += time4 - time3
+    result = {'bench': 'model', 'model': name, 'batch_size': batch_size, 'input': list(shape)}
+    for key, seconds in times.items():
+        result[key + '_ms'] = seconds / steps * 1000
+    result['train_img_s'] = batch_size * steps / sum(times.values())
+    return result
+
+
+def make_tree(path, num_class, per_class, seed = 0):
+    # tiny-imagenet layout: path/<class>/images/<class>_<i>.JPEG, 64x64 jpegs of noise
+    rng = np.random.RandomState(seed)
+    for c in range(num_class):
+        label = 'n%08d' % c
+        os.makedirs(os.path.join(path, label, 'images'))
+        for i in range(per_class):
+            Image.fromarray(rng.randint(0, 256, (64, 64, 3), dtype = np.uint8)).save(
+                os.path.join(path, label, 'images', '%s_%d.JPEG' % (label, i)))
+
+
+def bench_loader(batch_size, num_workers, num_class = 20, per_class = 50, batches = 20):
+    '''
+    TripleDataset + TripletSampler images per second (3 images per triplet) over a generated tree
+    '''
+    sol = load_script('mp5/sol.py')
+    sampler_module = load_script('mp5/sampler.py')
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(os.path.join(path, 'train'), num_class, per_class)
+        transform = transforms.Compose(
+            [transforms.Resize((224,224)),
+             transforms.RandomHorizontalFlip(),
+             transforms.ToTensor(),
+             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+        index = sampler_module.ClassIndex.from_tree(os.path.join(path, 'train'))
+        dataset = sol.TripleDataset(triplelist = index, root_dir = os.path.join(path, 'train'), train = 1, transform = transform)
+        loader = torch.utils.data.DataLoader(dataset, batch_size = batch_size, num_workers = num_workers,
+                                             sampler = sampler_module.TripletSampler(index))
+        batches = min(batches, len(loader))
+        time1 = time.time()
+        for i, data in enumerate(loader):
+            if i == 0:
+                # worker start-up is not part of the rate: batches 1 .. batches - 1 are timed
+                time1 = time.time()
+            if i == batches - 1:
+                break
+        seconds = time.time() - time1
+    finally:
+        shutil.rmtree(path)
+    return {'bench': 'loader', 'dataset': 'TripleDataset', 'batch_size': batch_size, 'num_workers': num_workers,
+            'img_s': 3 * batch_size * (batches - 1) / seconds}
+
+
+def bench_knn(gallery_size, dim, num_query, backend, k = 30):
+    # fit and search latency of one search backend on a random gallery
+    search = load_script('mp5/search.py')
+    rng = np.random.RandomState(0)
+    gallery = rng.randn(gallery_size, dim).astype(np.float32)
+    queries = rng.randn(num_query, dim).astype(np.float32)
+    labels = np.zeros(gallery_size, dtype = np.int64)
+    time1 = time.time()
+    if backend in search.index_classes:
+        # built in memory, load_index would cache it next to embedding.pkl
+        neigh = search.index_classes[backend]().fit(gallery)
+    else:
+        neigh = search.load_index(backend, gallery, labels, k)
+    time2 = time.time()
+    neigh.kneighbors(queries, k)
+    time3 = time.time()
+    return {'bench': 'knn', 'backend': backend, 'gallery_size': gallery_size, 'dim': dim, 'num_query': num_query, 'k': k,
+            'fit_s': time2 - time1, 'search_ms_per_query': (time3 - time2) / num_query * 1000}
+
+
+def meta():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = root, stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__,
+            'threads': torch.get_num_threads(), 'cpu': platform.processor() or platform.machine(), 'python': platform.python_version()}
+
+
+def compare(old_path, results):
+    # new / old for every measurement of the runs present in both files, matched on their settings
+    def key(result):
+        return tuple(sorted((k, str(v)) for k, v in result.items() if not isinstance(v, float)))
+    old = dict((key(result), result) for result in json.load(open(old_path))['results'])
+    for result in results:
+        if key(result) in old:
+            print(' '.join(str(v) for k, v in key(result)), ' '.join(
+                '%s=%.3fx' % (k, v / old[key(result)][k]) for k, v in result.items() if isinstance(v, float) and old[key(result)].get(k)))
+
+
+def main(argv):
+    names = ['net', 'resnet', 'resnet_mp5', 'resnet101']
+    batch_size = {'net': 100, 'resnet': 128, 'resnet_mp5': 128, 'resnet101': 16}
+    steps = 5
+    sizes = [1000, 10000, 50000]
+    backends = ['torch', 'exact']
+    dim = 4096
+    num_workers = [0, 4]
+    out = 'bench.json'
+    only = ['model', 'loader', 'knn']
+    old = None
+    try:
+        opts, args = getopt.getopt(argv, "", ["out=", "compare=", "only=", "models=", "steps=", "sizes=", "backends=", "dim=", "num_workers="])
+    except getopt.GetoptError:
+        print('suite.py --out=bench.json --compare=old.json --only=model,loader,knn --models=net,resnet,resnet_mp5,resnet101 --steps=5 '
+              '--sizes=1000,10000,50000 --backends=torch,exact,ivf,pq --dim=4096 --num_workers=0,4')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--out":
+            out = arg
+        elif opt == "--compare":
+            old = arg
+        elif opt == "--only":
+            only = arg.split(',')
+        elif opt == "--models":
+            names = arg.split(',')
+        elif opt == "--steps":
+            steps = int(arg)
+        elif opt == "--sizes":
+            sizes = [int(size) for size in arg.split(',')]
+        elif opt == "--backends":
+            backends = arg.split(',')
+        elif opt == "--dim":
+            dim = int(arg)
+        elif opt == "--num_workers":
+            num_workers = [int(n) for n in arg.split(',')]
+    # before the benches, which may change the torch thread count
+    info = meta()
+    results = []
+    def record(result):
+        print(' '.join('%s=%s' % (k, '%.4g' % v if isinstance(v, float) else v) for k, v in result.items()))
+        results.append(result)
+    if 'model' in only:
+        for name in names:
+            record(bench_model(name, batch_size[name], steps))
+    if 'loader' in only:
+        for n in num_workers:
+            record(bench_loader(32, n))
+    if 'knn' in only:
+        for size in sizes:
+            for backend in backends:
+                record(bench_knn(size, dim, 256, backend))
+    with open(out, 'w') as f:
+        json.dump({'meta': info, 'results': results}, f, indent = 1)
+    print('write', out)
+    if old:
+        compare(old, results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
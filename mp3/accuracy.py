@@ -0,0 +1,40 @@
+import torch
+import torch.distributed as dist
+
+
+class ClassAccuracy(object):
+    '''
+    confusion matrix and per class top-k hits, accumulated on the device with bincount
+    update() never copies to the host; counts() / confusion_matrix() / topk_accuracy() do, once
+    mp3/ and mp4/ carry the same file, each assignment folder runs on its own: keep them identical
+    '''
+    def __init__(self, num_classes, device, topk = 5):
+        self.num_classes = num_classes
+        self.topk = min(topk, num_classes)
+        self.confusion = torch.zeros(num_classes * num_classes, dtype = torch.int64, device = device)
+        self.topk_correct = torch.zeros(num_classes, dtype = torch.int64, device = device)
+
+    def update(self, outputs, labels):
+        with torch.no_grad():
+            predicted = outputs.argmax(1)
+            # row: true class, column: predicted class
+            self.confusion += torch.bincount(labels * self.num_classes + predicted, minlength = self.num_classes ** 2)
+            hit = (outputs.topk(self.topk, 1).indices == labels[:, None]).any(1)
+            self.topk_correct += torch.bincount(labels[hit], minlength = self.num_classes)
+
+    def all_reduce(self):
+        # sum of the counts of every rank
+        if dist.is_initialized():
+            dist.all_reduce(self.confusion)
+            dist.all_reduce(self.topk_correct)
+
+    def confusion_matrix(self):
+        return self.confusion.view(self.num_classes, self.num_classes).cpu().numpy()
+
+    def counts(self):
+        # per class (correct, total) as lists
+        confusion = self.confusion_matrix()
+        return confusion.diagonal().astype(float).tolist(), confusion.sum(1).astype(float).tolist()
+
+    def topk_accuracy(self):
+        return self.topk_correct.sum().item() / max(self.confusion.sum().item(), 1)
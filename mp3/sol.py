@@ -6,6 +6,14 @@ import torch.nn.functional as F
 import torch.optim as optim
 import torchvision
 import torchvision.transforms as transforms
+import sys, getopt
+import os
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from profiler import StepProfiler
+from accuracy import ClassAccuracy
+from tensor_data import CIFARTensorLoader
 class Net(nn.Module):
     def __init__(self):
         super(Net, self).__init__()
@@ -65,22 +73,86 @@ class Net(nn.Module):
         return x
 
 
-def main():
+def compile_model(net, enabled = True):
+    '''
+    forward function of net through torch.compile, falling back to eager when compilation fails
+    (compilation happens at the first call). net itself stays what is saved and optimized
+    same function as in mp4/sol.py and mp5/model.py, each assignment folder runs on its own
+    '''
+    if not enabled:
+        return net
+    try:
+        compiled = torch.compile(net)
+    except Exception as e:
+        print("torch.compile unavailable, running eager:", e)
+        return net
+    state = {'forward': compiled}
+    def forward(*args):
+        if state['forward'] is not net:
+            try:
+                return state['forward'](*args)
+            except Exception as e:
+                print("torch.compile failed, running eager:", e)
+                state['forward'] = net
+        return net(*args)
+    return forward
+
+
+def main(argv):
+    amp = None
+    channels_last = False
+    compile = False
+    profile = None
+    profile_every = 50
+    trace = None
+    tensor_data = False
+    try:
+        opts,args = getopt.getopt(argv, "", ["amp=", "channels_last", "compile", "profile=", "profile_every=", "trace=", "tensor_data"])
+    except getopt.GetoptError:
+        print('sol.py --amp=bf16|fp16 --channels_last --compile --profile=steps.jsonl --profile_every=50 --trace=first:last --tensor_data')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--amp":
+            amp = arg
+        elif opt == "--channels_last":
+            channels_last = True
+        elif opt == "--compile":
+            compile = True
+        elif opt == "--profile":
+            profile = arg
+        elif opt == "--profile_every":
+            profile_every = int(arg)
+        elif opt == "--trace":
+            trace = tuple(int(step) for step in arg.split(':'))
+        elif opt == "--tensor_data":
+            tensor_data = True
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    # torchrun --nproc_per_node=N sol.py: one process per rank over gloo, each rank trains on its shard
+    rank, world_size = int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1:
+        dist.init_process_group('gloo')
     transform = transforms.Compose(
         [transforms.RandomHorizontalFlip(),
          transforms.RandomRotation(20),
          transforms.ToTensor(),
          transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
 
+    if rank > 0:
+        # rank 0 downloads first
+        dist.barrier()
     trainset = torchvision.datasets.CIFAR10(root='./data', train=True,
                                             download=True, transform=transform)
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=100,
-                                              shuffle=True, num_workers = 0)
-
     testset = torchvision.datasets.CIFAR10(root='./data', train=False,
                                            download=True, transform=transform)
+    if rank == 0 and world_size > 1:
+        dist.barrier()
+    train_sampler = DistributedSampler(trainset, world_size, rank) if world_size > 1 else None
+    # evaluation shards are not padded (DistributedSampler would repeat images), each test image is counted once
+    test_sampler = range(rank, len(testset), world_size) if world_size > 1 else None
+    trainloader = torch.utils.data.DataLoader(trainset, batch_size=100,
+                                              shuffle=train_sampler is None, sampler = train_sampler, num_workers = 0)
     testloader = torch.utils.data.DataLoader(testset, batch_size=100,
-                                             shuffle=False, num_workers = 0)
+                                             shuffle=False, sampler = test_sampler, num_workers = 0)
 
     classes = ('plane', 'car', 'bird', 'cat',
                'deer', 'dog', 'frog', 'horse', 'ship', 'truck')
@@ -90,64 +162,94 @@ def main():
     optimizer = optim.Adam(net.parameters(), lr = 0.0001)
     if torch.cuda.is_available():
         print('cuda')
-        device = torch.device('cuda:0')
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
     else:
         print('cpu')
         device = torch.device('cpu')
     print(device)
-    net.to(device)
+    if tensor_data:
+        # the whole split on the device, flip and rotation done a batch at a time (tensor_data.py)
+        trainloader = CIFARTensorLoader(trainset, device, 100, shuffle = True, flip = True, rotation = 20, rank = rank, world_size = world_size)
+        testloader = CIFARTensorLoader(testset, device, 100, flip = True, rotation = 20, rank = rank, world_size = world_size,
+                                       drop_last = False)
+        # set_epoch reshuffles
+        train_sampler = trainloader
+    net.to(device, memory_format = memory_format)
+    # static graph: the same parameters every step (fc2 is never used), no unused parameter search
+    model = compile_model(DistributedDataParallel(net, static_graph = True) if world_size > 1 else net, compile)
+    # opt-in reduced precision: bf16 autocast (cpu or cuda), fp16 needs the gradient scaler on cuda
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[amp] if amp else None
+    if amp_dtype == torch.float16 and device.type != 'cuda':
+        # no gradient scaler off cuda, fp16 gradients would underflow unnoticed
+        print('--amp=fp16 needs cuda, training with bf16')
+        amp_dtype = torch.bfloat16
+    scaler = torch.amp.GradScaler('cuda', enabled = amp_dtype == torch.float16 and device.type == 'cuda')
+    # per stage step times of rank 0, see profiler.py
+    profiler = StepProfiler(profile if rank == 0 else None, profile_every, device, trace if rank == 0 else None)
     time1 = time.time()
     net.train()
     for epoch in range(60):  # loop over the dataset multiple times
         time2 = time.time()
-        class_correct = list(0. for i in range(10))
-        class_total = list(0. for i in range(10))
+        accuracy = ClassAccuracy(10, device)
         running_loss = 0.0
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         if (epoch > 6):
             for group in optimizer.param_groups:
                 for p in group['params']:
                     state = optimizer.state[p]
                     if ('step' in state and state['step'] >= 1024):
                         state['step'] = 1000
+        profiler.start(epoch)
         for i, data in enumerate(trainloader, 0):
             # get the inputs
             inputs, labels = data
-            inputs, labels = inputs.to(device), labels.to(device)
+            profiler.mark('data')
+            inputs, labels = inputs.to(device, memory_format = memory_format), labels.to(device)
+            profiler.mark('h2d')
             # zero the parameter gradients
             optimizer.zero_grad()
 
             # forward + backward + optimize
-            outputs = net(inputs)
-            _, predicted = torch.max(outputs, 1)
-            c = (predicted == labels).squeeze()
-            for j in range(100):
-                label = labels[j]
-                class_correct[label] += c[j].item()
-                class_total[label] += 1
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+            with torch.autocast(device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+                outputs = model(inputs)
+                profiler.mark('forward')
+                loss = criterion(outputs, labels)
+            profiler.mark('loss')
+            accuracy.update(outputs, labels)
+            profiler.mark('other')
+            scaler.scale(loss).backward()
+            profiler.mark('backward')
+            scaler.step(optimizer)
+            scaler.update()
+            profiler.mark('optimizer')
 
             # print statistics
             running_loss += loss.item()
-            if i % 100 == 99:  # print every 2000 mini-batches
+            if i % 100 == 99 and rank == 0:  # print every 2000 mini-batches
                 print('[%d, %5d] loss: %.3f' %
                       (epoch + 1, i + 1, running_loss / 99))
                 running_loss = 0.0
-        total_acc = 0
-        for i in range(10):
-            print('Accuracy of %5s : %2d %%' % (
-                classes[i], 100 * class_correct[i] / class_total[i]))
-            total_acc += 100 * class_correct[i] / class_total[i]
-        print("average acc: ", total_acc/10)
-        print('One time: ', time.time() - time2)
+            profiler.step(len(labels))
+        # class counts of all shards, copied to the host once per epoch
+        accuracy.all_reduce()
+        class_correct, class_total = accuracy.counts()
+        if rank == 0:
+            print("top-5 acc: ", 100 * accuracy.topk_accuracy())
+            total_acc = 0
+            for i in range(10):
+                print('Accuracy of %5s : %2d %%' % (
+                    classes[i], 100 * class_correct[i] / class_total[i]))
+                total_acc += 100 * class_correct[i] / class_total[i]
+            print("average acc: ", total_acc/10)
+            print('One time: ', time.time() - time2)
+    profiler.close()
     print('Total time: ', time.time() -time1)
 
     print('Finished Training')
     print('Start Testing')
     time3 = time.time()
-    class_correct = list(0. for i in range(10))
-    class_total = list(0. for i in range(10))
+    accuracy = ClassAccuracy(10, device)
     running_loss = 0.0
     net.eval()
     for i, data in enumerate(testloader, 0):
@@ -158,13 +260,9 @@ def main():
        # optimizer.zero_grad()
 
         # forward + backward + optimize
-        outputs = net(inputs)
-        _, predicted = torch.max(outputs, 1)
-        c = (predicted == labels).squeeze()
-        for j in range(100):
-            label = labels[j]
-            class_correct[label] += c[j].item()
-            class_total[label] += 1
+        with torch.autocast(device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+            outputs = net(inputs)
+        accuracy.update(outputs, labels)
         # loss = criterion(outputs, labels)
         # loss.backward()
         # optimizer.step()
@@ -175,12 +273,20 @@ def main():
         #     print('[%d, %5d] loss: %.3f' %
         #           (epoch + 1, i + 1, running_loss / 29))
         #     running_loss = 0.0
-    total_acc = 0
-    for i in range(10):
-        print('Accuracy of %5s : %2d %%' % (
-            classes[i], 100 * class_correct[i] / class_total[i]))
-        total_acc += 100 * class_correct[i] / class_total[i]
-    print("average acc of testing: ", total_acc/10)
-    print('One time: ', time.time()- time3)
+    accuracy.all_reduce()
+    class_correct, class_total = accuracy.counts()
+    if world_size > 1:
+        dist.destroy_process_group()
+    if rank == 0:
+        np.save('confusion.npy', accuracy.confusion_matrix())
+        print("top-5 acc of testing: ", 100 * accuracy.topk_accuracy())
+        total_acc = 0
+        for i in range(10):
+            print('Accuracy of %5s : %2d %%' % (
+                classes[i], 100 * class_correct[i] / class_total[i]))
+            total_acc += 100 * class_correct[i] / class_total[i]
+        print("average acc of testing: ", total_acc/10)
+        print('One time: ', time.time()- time3)
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main(sys.argv[1:])
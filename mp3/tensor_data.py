@@ -0,0 +1,74 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class CIFARTensorLoader(object):
+    '''
+    a whole torchvision CIFAR split kept as one uint8 tensor on the device, iterated in batches of
+    (normalized images, labels) like a DataLoader
+    the augmentation of the PIL pipeline (RandomHorizontalFlip, RandomCrop(size, crop),
+    RandomRotation(rotation)) is one affine matrix per image, applied to the whole batch with a
+    single affine_grid / grid_sample (nearest, zero fill as in PIL); size != 32 also resizes
+    the shuffling and the augmentation parameters come from (seed, epoch), so a run is reproducible;
+    with world_size > 1 each rank iterates every world_size-th image of an epoch; drop_last (training)
+    gives every rank the same number of images, drop_last = False (evaluation) keeps every image once
+    mp3/ and mp4/ carry the same file, each assignment folder runs on its own: keep them identical
+    '''
+    def __init__(self, dataset, device, batch_size, shuffle = False, flip = False, crop = 0, rotation = 0, size = 32,
+                 mean = (0.5, 0.5, 0.5), std = (0.5, 0.5, 0.5), seed = 0, rank = 0, world_size = 1, drop_last = True):
+        # dataset.data: (N, 32, 32, 3) uint8, dataset.targets: N ints
+        self.images = torch.from_numpy(np.ascontiguousarray(dataset.data.transpose(0, 3, 1, 2))).to(device)
+        self.labels = torch.as_tensor(dataset.targets, dtype = torch.int64).to(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.flip = flip
+        self.crop = crop
+        self.rotation = rotation
+        self.size = size
+        self.mean = torch.tensor(mean, device = device).view(1, 3, 1, 1)
+        self.std = torch.tensor(std, device = device).view(1, 3, 1, 1)
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.num_samples = len(self.images) // world_size if drop_last else len(range(rank, len(self.images), world_size))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def augment(self, images, generator):
+        n = len(images)
+        # image k of the output samples the input at F (R x + t): rotate, then crop offset, then flip
+        angle = (torch.rand(n, generator = generator) * 2 - 1) * math.radians(self.rotation)
+        shift = torch.randint(-self.crop, self.crop + 1, (n, 2), generator = generator).float() * 2 / self.size
+        sign = torch.where(torch.rand(n, generator = generator) < 0.5, -1., 1.) if self.flip else torch.ones(n)
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = sign * torch.cos(angle)
+        theta[:, 0, 1] = -sign * torch.sin(angle)
+        theta[:, 1, 0] = torch.sin(angle)
+        theta[:, 1, 1] = torch.cos(angle)
+        theta[:, 0, 2] = sign * shift[:, 0]
+        theta[:, 1, 2] = shift[:, 1]
+        grid = F.affine_grid(theta.to(images.device), (n, 3, self.size, self.size), align_corners = False)
+        return F.grid_sample(images, grid, mode = 'nearest', padding_mode = 'zeros', align_corners = False)
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed * 1000003 + self.epoch)
+        if self.shuffle:
+            order = torch.randperm(len(self.images), generator = generator)
+        else:
+            order = torch.arange(len(self.images))
+        order = order[self.rank::self.world_size][:self.num_samples].to(self.images.device)
+        augment = self.flip or self.crop or self.rotation or self.size != self.images.shape[-1]
+        for start in range(0, len(order), self.batch_size):
+            index = order[start:start + self.batch_size]
+            images = self.images[index].float().div_(255)
+            if augment:
+                images = self.augment(images, generator)
+            yield (images - self.mean) / self.std, self.labels[index]
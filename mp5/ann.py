@@ -0,0 +1,116 @@
+import time
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+
+class IVFIndex(object):
+    '''
+    approximate nearest neighbour index (inverted file, flat vectors)
+    gallery vectors are bucketed by their nearest coarse k-means centroid,
+    a query only scans the nprobe buckets closest to it.
+    nprobe is the recall/speed knob: nprobe = nlist is an exact search
+    '''
+    def __init__(self, nlist=256, nprobe=8):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        # gallery rows grouped by list, list l is [list_offsets[l], list_offsets[l + 1])
+        self.list_offsets = None
+        self.ids = None
+        self.vectors = None
+        self.sq_norms = None
+
+    def fit(self, X, train_size=20000, seed=0):
+        X = np.asarray(X, dtype=np.float32)
+        time1 = time.time()
+        rng = np.random.RandomState(seed)
+        sample = X[rng.choice(len(X), min(train_size, len(X)), replace=False)]
+        kmeans = MiniBatchKMeans(n_clusters=self.nlist, batch_size=4096, n_init=3, random_state=seed)
+        kmeans.fit(sample)
+        self.centroids = kmeans.cluster_centers_.astype(np.float32)
+        print("train coarse quantizer", time.time() - time1)
+
+        assign = self._probe(X, 1)[:, 0]
+        order = np.argsort(assign, kind='stable')
+        self.ids = order
+        self.vectors = X[order]
+        self.sq_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=self.nlist))))
+        print("build inverted lists", time.time() - time1)
+        return self
+
+    def _probe(self, X, nprobe, block_size=4096):
+        # ids of the nprobe closest centroids for every row of X
+        c_sq = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        out = np.empty((len(X), nprobe), dtype=np.int64)
+        for start in range(0, len(X), block_size):
+            x = np.asarray(X[start:start + block_size], dtype=np.float32)
+            d = c_sq[None, :] - 2 * x.dot(self.centroids.T)
+            if nprobe < self.nlist:
+                part = np.argpartition(d, nprobe - 1, axis=1)[:, :nprobe]
+            else:
+                part = np.tile(np.arange(self.nlist), (len(x), 1))
+            order = np.argsort(np.take_along_axis(d, part, 1), axis=1)
+            out[start:start + len(x)] = np.take_along_axis(part, order, 1)
+        return out
+
+    def kneighbors(self, X, n_neighbors=5, nprobe=None):
+        '''
+        same return value as sklearn kneighbors: (distances, indices), sorted
+        rows that reach fewer than n_neighbors vectors are padded with inf / -1
+        '''
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        X = np.asarray(X, dtype=np.float32)
+        num_query = len(X)
+        probe = self._probe(X, nprobe)
+        x_sq = np.einsum('ij,ij->i', X, X)
+        best_d = np.full((num_query, n_neighbors), np.inf, dtype=np.float32)
+        best_i = np.full((num_query, n_neighbors), -1, dtype=np.int64)
+
+        # visit every list once, with all the queries that probe it
+        flat = probe.ravel()
+        order = np.argsort(flat, kind='stable')
+        query_of = order // nprobe
+        bounds = np.searchsorted(flat[order], np.arange(self.nlist + 1))
+        for l in range(self.nlist):
+            start, end = self.list_offsets[l], self.list_offsets[l + 1]
+            if bounds[l] == bounds[l + 1] or start == end:
+                continue
+            q = query_of[bounds[l]:bounds[l + 1]]
+            d = x_sq[q, None] - 2 * X[q].dot(self.vectors[start:end].T) + self.sq_norms[None, start:end]
+            cand_d = np.concatenate((best_d[q], d), 1)
+            cand_i = np.concatenate((best_i[q], np.broadcast_to(self.ids[start:end], d.shape)), 1)
+            top = np.argpartition(cand_d, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            best_d[q] = np.take_along_axis(cand_d, top, 1)
+            best_i[q] = np.take_along_axis(cand_i, top, 1)
+
+        order = np.argsort(best_d, axis=1)
+        best_d = np.sqrt(np.maximum(np.take_along_axis(best_d, order, 1), 0))
+        best_i = np.take_along_axis(best_i, order, 1)
+        return best_d, best_i
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, ids=self.ids,
+                     vectors=self.vectors, sq_norms=self.sq_norms, nprobe=self.nprobe)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(nlist=len(data['centroids']), nprobe=int(data['nprobe']))
+        index.centroids = data['centroids']
+        index.list_offsets = data['list_offsets']
+        index.ids = data['ids']
+        index.vectors = data['vectors']
+        index.sq_norms = data['sq_norms']
+        return index
+
+
+def recall_at_k(approx_indices, exact_indices, k):
+    '''
+    fraction of the exact top k neighbours that the approximate search returned
+    '''
+    approx_indices = np.asarray(approx_indices)[:, :k]
+    exact_indices = np.asarray(exact_indices)[:, :k]
+    hit = (exact_indices[:, :, None] == approx_indices[:, None, :]).any(2)
+    return hit.sum() / float(exact_indices.size)
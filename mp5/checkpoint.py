@@ -0,0 +1,107 @@
+import os
+import copy
+import glob
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    # cpu copy of every tensor in a (nested) state dict, safe to write while training mutates the originals
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy = True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager(object):
+    '''
+    full training checkpoints written by a background thread
+    save() only takes a cpu snapshot and returns; the writer thread saves it under a temporary
+    name, fsyncs and renames, so a checkpoint file is either complete or absent.
+    only the newest keep checkpoints stay on disk.
+    exports writes parts of the state to extra files as well, e.g. {'model.pt': 'model'}
+    '''
+    def __init__(self, directory = 'checkpoints', keep = 3):
+        self.directory = directory
+        self.keep = keep
+        self.error = None
+        os.makedirs(directory, exist_ok = True)
+        # at most one snapshot waits while another one is written
+        self.queue = queue.Queue(maxsize = 1)
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def path(self, epoch):
+        return os.path.join(self.directory, 'checkpoint_%04d.pt' % epoch)
+
+    def save(self, state, epoch, exports = None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((epoch, snapshot(state), exports or {}))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                epoch, state, exports = item
+                self.write(state, self.path(epoch))
+                for path, key in exports.items():
+                    self.write(state[key], path)
+                self.prune()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, obj, path):
+        with open(path + '.tmp', 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def prune(self):
+        for path in self.checkpoints()[:-self.keep]:
+            os.remove(path)
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'checkpoint_*.pt')))
+
+    def load(self):
+        # newest checkpoint or None
+        paths = self.checkpoints()
+        if not paths:
+            return None
+        print("load checkpoint", paths[-1])
+        return torch.load(paths[-1], map_location = 'cpu', weights_only = False)
+
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,50 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed():
+    '''
+    torchrun launch (torchrun --nproc_per_node=4 sol.py): RANK, WORLD_SIZE, MASTER_ADDR and
+    MASTER_PORT come from the environment and the ranks talk over gloo
+    a plain python run is rank 0 of 1 and nothing is initialized
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group('gloo')
+    return int(os.environ.get('RANK', 0)), world_size
+
+
+def rank_device():
+    if torch.cuda.is_available():
+        return torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    return torch.device('cpu')
+
+
+def all_reduce(tensor):
+    # in place sum over the ranks
+    if dist.is_initialized():
+        dist.all_reduce(tensor)
+    return tensor
+
+
+def all_gather_rows(x):
+    '''
+    rank r holds rows r, r + world_size, r + 2 * world_size, ... of a block (the same count on every rank);
+    returns the whole block in row order on every rank
+    '''
+    if not dist.is_initialized():
+        return x
+    parts = [torch.empty_like(x) for i in range(dist.get_world_size())]
+    dist.all_gather(parts, x)
+    return torch.stack(parts, 1).reshape(-1, *x.shape[1:])
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
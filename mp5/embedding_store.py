@@ -0,0 +1,57 @@
+import os
+import numpy as np
+
+
+class EmbeddingStore(object):
+    '''
+    preallocated (num_rows, dim) embedding array on disk, filled in place batch by batch
+    the file is a plain .npy written under a temporary name and renamed on close,
+    so readers never see a half written gallery
+    with resume=True, a partial file left by checkpoint() is reopened and filling
+    continues after the last checkpointed row
+    '''
+    def __init__(self, path, num_rows, dtype=np.float32, resume=False):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.rows_path = path + '.rows'
+        self.num_rows = num_rows
+        self.dtype = np.dtype(dtype)
+        self.array = None
+        self.num_written = 0
+        if resume and os.path.isfile(self.tmp_path) and os.path.isfile(self.rows_path):
+            array = np.lib.format.open_memmap(self.tmp_path, mode='r+')
+            if array.shape[0] == num_rows and array.dtype == self.dtype:
+                self.array = array
+                self.num_written = int(open(self.rows_path).read())
+
+    def append(self, rows):
+        if self.array is None:
+            # the embedding width is only known once the first batch arrives
+            self.array = np.lib.format.open_memmap(self.tmp_path, mode='w+', dtype=self.dtype,
+                                                   shape=(self.num_rows, rows.shape[1]))
+        end = self.num_written + len(rows)
+        self.array[self.num_written:end] = rows
+        self.num_written = end
+
+    def checkpoint(self):
+        # everything before num_written is on disk once the row count is
+        if self.array is None:
+            return
+        self.array.flush()
+        with open(self.rows_path + '.tmp', 'w') as f:
+            f.write(str(self.num_written))
+        os.replace(self.rows_path + '.tmp', self.rows_path)
+
+    def close(self):
+        if self.num_written != self.num_rows:
+            raise ValueError('embedding store %s got %d rows, expected %d' % (self.path, self.num_written, self.num_rows))
+        self.array.flush()
+        self.array = None
+        os.replace(self.tmp_path, self.path)
+        if os.path.isfile(self.rows_path):
+            os.remove(self.rows_path)
+
+
+def open_embedding(path):
+    # zero-copy read only view of a gallery written by EmbeddingStore (or np.save)
+    return np.load(path, mmap_mode='r')
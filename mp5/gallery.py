@@ -0,0 +1,121 @@
+import time
+import sys, getopt
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset, Subset
+from model import build_embedder
+from PIL import Image
+from pack import PackedImages
+from sampler import ClassIndex
+from embedding_store import EmbeddingStore
+from distributed import init_distributed, rank_device, all_gather_rows, cleanup
+
+
+class GalleryDataset(Dataset):
+    '''
+    every training image once, in ClassIndex order, without augmentation
+    '''
+    def __init__(self, index, root_dir, transform, packed = None):
+        self.index = index
+        self.root_dir = root_dir
+        self.transform = transform
+        self.images = PackedImages(packed) if packed else None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        name = self.index.name(idx)
+        if self.images is not None:
+            image = self.images.get(name)
+        else:
+            image = Image.open(self.root_dir + '/' + self.index.label(idx) + '/images/' + name).convert('RGB')
+        return self.transform(image)
+
+
+def build_gallery(model_path = 'model.pt', root_dir = 'tiny-imagenet-200/train', out = 'embedding.pkl',
+                  batch_size = 256, embedding_dtype = np.float32, packed = None, chunk_rows = 8192, num_workers = 4):
+    '''
+    embed every training image with the fine-tuned model in eval mode, no autograd,
+    into the gallery files test.py reads (embedding.pkl, train_image_name.pkl, train_image_name_real.pkl)
+    rows are checkpointed every chunk_rows, a killed run picks up where it stopped
+    under torchrun rank r embeds rows r, r + world_size, ... and rank 0 writes the gathered rows in order
+    '''
+    transform = transforms.Compose(
+        [transforms.Resize((224,224)),
+         transforms.ToTensor(),
+         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+    net = build_embedder(model_path, pretrained = False)
+    rank, world_size = init_distributed()
+    device = rank_device()
+    print(device, 'rank', rank, 'of', world_size)
+    net.to(device)
+    net.eval()
+
+    index = ClassIndex.from_tree(root_dir)
+    start = torch.zeros(1, dtype = torch.int64)
+    if rank == 0:
+        with open('train_image_name.pkl', 'wb') as f:
+            np.save(f, np.array([str(label) for label in index.classes[index.label_ids]]))
+        with open('train_image_name_real.pkl', 'wb') as f:
+            np.save(f, np.array([name.decode() for name in index.names]))
+        store = EmbeddingStore(out, len(index), embedding_dtype, resume = True)
+        start[0] = store.num_written
+        if store.num_written:
+            print("resume gallery at row", store.num_written)
+    if world_size > 1:
+        torch.distributed.broadcast(start, 0)
+    start = int(start[0])
+    # the same number of rows on every rank, the last row repeats to fill the final block
+    rows = np.minimum(np.arange(start + rank, len(index) + world_size - 1, world_size), len(index) - 1)
+    dataset = Subset(GalleryDataset(index, root_dir, transform, packed), rows[:(len(index) - start + world_size - 1) // world_size])
+    loader = torch.utils.data.DataLoader(dataset, batch_size = batch_size, shuffle = False, num_workers = num_workers)
+    time1 = time.time()
+    last_checkpoint = start
+    written = start
+    with torch.inference_mode():
+        for i, images in enumerate(loader, 0):
+            outputs = all_gather_rows(net(images.to(device)).float())
+            outputs = outputs[:len(index) - written]
+            written += len(outputs)
+            if rank == 0:
+                store.append(outputs.cpu().numpy())
+                if store.num_written - last_checkpoint >= chunk_rows:
+                    store.checkpoint()
+                    last_checkpoint = store.num_written
+                    print('gallery rows', store.num_written, 'of', len(index), time.time() - time1)
+    if rank == 0:
+        store.close()
+    cleanup()
+    print("output train embedding array", time.time() - time1)
+
+
+def main(argv):
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(argv, "", ["model=", "root=", "out=", "batch_size=", "embedding_dtype=",
+                                              "packed=", "chunk_rows="])
+    except getopt.GetoptError:
+        print('gallery.py --model=model.pt --batch_size=256 --embedding_dtype=float16 --packed=tiny_packed')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--model":
+            kwargs['model_path'] = arg
+        elif opt == "--root":
+            kwargs['root_dir'] = arg
+        elif opt == "--out":
+            kwargs['out'] = arg
+        elif opt == "--batch_size":
+            kwargs['batch_size'] = int(arg)
+        elif opt == "--embedding_dtype":
+            kwargs['embedding_dtype'] = np.dtype(arg)
+        elif opt == "--packed":
+            kwargs['packed'] = arg + '_train'
+        elif opt == "--chunk_rows":
+            kwargs['chunk_rows'] = int(arg)
+    build_gallery(**kwargs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
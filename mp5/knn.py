@@ -0,0 +1,104 @@
+import numpy as np
+import torch
+
+
+def _as_tensor(X):
+    # memmap / float16 galleries are converted one block at a time,
+    # read only memmap blocks are copied since torch tensors have to be writable
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    if not X.flags.writeable:
+        X = X.copy()
+    return torch.from_numpy(X)
+
+
+def _merge(best_d, best_i, tile_d, tile_i, k, largest):
+    # keep the k best of the running set and a freshly selected tile
+    cand_d = torch.cat((best_d, tile_d), 1)
+    cand_i = torch.cat((best_i, tile_i), 1)
+    top_d, top_pos = torch.topk(cand_d, k, dim=1, largest=largest)
+    return top_d, torch.gather(cand_i, 1, top_pos)
+
+
+def near_far_search(queries, gallery, k_near, k_far, metric='l2', query_block=4096, gallery_block=16384):
+    '''
+    exact k_near nearest and k_far farthest neighbours from one pass over the gallery
+    returns ((near_distances, near_indices), (far_distances, far_indices)),
+    nearest first and farthest first respectively, like sklearn kneighbors
+    the distance matrix is only ever materialised one query_block x gallery_block tile
+    at a time; every tile is reduced with topk (partial selection) at both ends
+    and merged into the running sets
+    metric 'l2' returns euclidean distances, 'cosine' returns 1 - cosine similarity
+    '''
+    queries = _as_tensor(queries)
+    num_query = len(queries)
+    k_near = min(k_near, len(gallery))
+    k_far = min(k_far, len(gallery))
+    if metric == 'cosine':
+        queries = torch.nn.functional.normalize(queries, dim=1)
+    elif metric != 'l2':
+        raise ValueError('unknown metric %s' % metric)
+    q_sq = (queries * queries).sum(1, keepdim=True)
+    near_d = torch.full((num_query, k_near), float('inf'))
+    near_i = torch.full((num_query, k_near), -1, dtype=torch.int64)
+    far_d = torch.full((num_query, k_far), -float('inf'))
+    far_i = torch.full((num_query, k_far), -1, dtype=torch.int64)
+
+    with torch.no_grad():
+        for g_start in range(0, len(gallery), gallery_block):
+            g = _as_tensor(gallery[g_start:g_start + gallery_block])
+            if metric == 'cosine':
+                g = torch.nn.functional.normalize(g, dim=1)
+            else:
+                g_sq = (g * g).sum(1)
+            g_ids = torch.arange(g_start, g_start + len(g))
+            for q_start in range(0, num_query, query_block):
+                q = slice(q_start, min(q_start + query_block, num_query))
+                dot = torch.mm(queries[q], g.t())
+                if metric == 'cosine':
+                    d = 1 - dot
+                else:
+                    d = (q_sq[q] - 2 * dot + g_sq).clamp_(min=0)
+                if k_near:
+                    tile_d, tile_pos = torch.topk(d, min(k_near, len(g)), dim=1, largest=False)
+                    near_d[q], near_i[q] = _merge(near_d[q], near_i[q], tile_d, g_ids[tile_pos], k_near, False)
+                if k_far:
+                    tile_d, tile_pos = torch.topk(d, min(k_far, len(g)), dim=1, largest=True)
+                    far_d[q], far_i[q] = _merge(far_d[q], far_i[q], tile_d, g_ids[tile_pos], k_far, True)
+
+    if metric == 'l2':
+        near_d = near_d.sqrt()
+        far_d = far_d.sqrt()
+    return (near_d.numpy(), near_i.numpy()), (far_d.numpy(), far_i.numpy())
+
+
+def knn_search(queries, gallery, k, metric='l2', query_block=4096, gallery_block=16384):
+    '''
+    exact top k search, same return value as sklearn kneighbors: (distances, indices)
+    '''
+    return near_far_search(queries, gallery, k, 0, metric, query_block, gallery_block)[0]
+
+
+class TorchKNN(object):
+    '''
+    blocked torch matmul exact search with the sklearn fit / kneighbors interface
+    num_threads: torch threads for the search only, the process setting is restored afterwards
+    '''
+    def __init__(self, n_neighbors=5, metric='l2', num_threads=None):
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.num_threads = num_threads
+        self.gallery = None
+
+    def fit(self, X, y=None):
+        self.gallery = X
+        return self
+
+    def kneighbors(self, X, n_neighbors=None):
+        if not self.num_threads:
+            return knn_search(X, self.gallery, n_neighbors or self.n_neighbors, self.metric)
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        try:
+            return knn_search(X, self.gallery, n_neighbors or self.n_neighbors, self.metric)
+        finally:
+            torch.set_num_threads(num_threads)
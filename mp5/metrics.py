@@ -0,0 +1,51 @@
+import numpy as np
+
+
+def retrieval_metrics(indices, gallery_labels, query_labels, ks=(1, 5, 10, 30)):
+    '''
+    score a whole (num_query, n) matrix of ranked gallery row ids at once
+    precision@k: fraction of the top k with the query's class
+    recall@k: fraction of queries with at least one same class image in the top k
+    mAP: mean average precision over the n returned neighbours
+    per_class: class -> precision@n and AP averaged over the queries of that class
+    negative ids (padding from an approximate index) never count as a hit
+    '''
+    indices = np.asarray(indices)
+    gallery_labels = np.asarray(gallery_labels)
+    query_labels = np.asarray(query_labels)
+    num_neighbors = indices.shape[1]
+
+    # labels become integer codes so the comparison below is a single array op
+    classes, codes = np.unique(np.concatenate((gallery_labels, query_labels)), return_inverse=True)
+    gallery_codes = codes[:len(gallery_labels)]
+    query_codes = codes[len(gallery_labels):]
+    relevant = (gallery_codes[indices] == query_codes[:, None]) & (indices >= 0)
+
+    hits = np.cumsum(relevant, axis=1)
+    precision = hits / np.arange(1, num_neighbors + 1, dtype=np.float64)
+    ap = (precision * relevant).sum(1) / np.maximum(hits[:, -1], 1)
+
+    result = {}
+    for k in ks:
+        if k > num_neighbors:
+            continue
+        result['precision@%d' % k] = precision[:, k - 1].mean()
+        result['recall@%d' % k] = (hits[:, k - 1] > 0).mean()
+    result['mAP'] = ap.mean()
+
+    count = np.bincount(query_codes, minlength=len(classes))
+    class_precision = np.bincount(query_codes, weights=precision[:, -1], minlength=len(classes))
+    class_ap = np.bincount(query_codes, weights=ap, minlength=len(classes))
+    result['per_class'] = dict((classes[c], {'precision@%d' % num_neighbors: class_precision[c] / count[c],
+                                             'AP': class_ap[c] / count[c]})
+                               for c in np.nonzero(count)[0])
+    return result
+
+
+def print_metrics(result):
+    for name, value in result.items():
+        if name != 'per_class':
+            print('%s: %.4f' % (name, value))
+    worst = sorted(result['per_class'].items(), key=lambda item: item[1]['AP'])[:5]
+    for label, value in worst:
+        print('worst class %s: %s' % (label, ', '.join('%s %.4f' % kv for kv in value.items())))
@@ -0,0 +1,42 @@
+import torch
+import torch.nn.functional as F
+
+
+def pairwise_distance(embeddings):
+    # euclidean distance matrix, clamped before the sqrt so the diagonal has a finite gradient
+    sq = (embeddings * embeddings).sum(1)
+    d = sq[:, None] - 2 * torch.mm(embeddings, embeddings.t()) + sq[None, :]
+    return d.clamp(min=1e-12).sqrt()
+
+
+def batch_hard_triplet_loss(embeddings, labels, margin=1.0):
+    '''
+    every image is an anchor with its farthest positive and closest negative in the batch
+    '''
+    dist = pairwise_distance(embeddings)
+    same = labels[:, None] == labels[None, :]
+    hardest_positive = dist.masked_fill(~same, 0).max(1)[0]
+    hardest_negative = dist.masked_fill(same, float('inf')).min(1)[0]
+    return F.relu(hardest_positive - hardest_negative + margin).mean()
+
+
+def batch_all_triplet_loss(embeddings, labels, margin=1.0):
+    '''
+    every valid (anchor, positive, negative) triplet of the batch,
+    averaged over the triplets that still violate the margin
+    '''
+    dist = pairwise_distance(embeddings)
+    same = labels[:, None] == labels[None, :]
+    eye = torch.eye(len(labels), dtype=torch.bool, device=labels.device)
+    valid = (same & ~eye)[:, :, None] & ~same[:, None, :]
+    loss = F.relu(dist[:, :, None] - dist[:, None, :] + margin) * valid
+    num_active = (loss > 1e-16).sum()
+    return loss.sum() / num_active.clamp(min=1)
+
+
+def triplet_mining_loss(embeddings, labels, mode='hard', margin=1.0):
+    if mode == 'hard':
+        return batch_hard_triplet_loss(embeddings, labels, margin)
+    if mode == 'all':
+        return batch_all_triplet_loss(embeddings, labels, margin)
+    raise ValueError('unknown mining mode %s' % mode)
@@ -0,0 +1,67 @@
+import os
+import time
+import torch
+import torch.nn as nn
+from torchvision import models as t_models
+
+embedding_size = 4096
+
+
+def _build(arch, pretrained, embedding_size):
+    net = getattr(t_models, arch)(pretrained = pretrained)
+    net.fc = nn.Linear(net.fc.in_features, embedding_size)
+    return net
+
+
+def build_embedder(model_path = 'model.pt', arch = 'resnet101', embedding_size = embedding_size, pretrained = True):
+    '''
+    torchvision backbone with the embedding head
+    when model_path exists its weights are the only ones that matter: the architecture is built
+    without ImageNet weights on the meta device (no download, no random init) and the
+    memory-mapped checkpoint tensors are assigned in place, so the weights exist once
+    otherwise the ImageNet pretrained backbone is the starting point; a missing model_path with
+    pretrained = False is an error rather than a randomly initialised embedder (model_path = None builds one)
+    '''
+    time1 = time.time()
+    if model_path and not pretrained and not os.path.isfile(model_path):
+        raise FileNotFoundError('no trained model at %s' % model_path)
+    if model_path and os.path.isfile(model_path):
+        try:
+            with torch.device('meta'):
+                net = _build(arch, False, embedding_size)
+            state_dict = torch.load(model_path, map_location = 'cpu', mmap = True, weights_only = True)
+            net.load_state_dict(state_dict, assign = True)
+        except (AttributeError, TypeError):
+            # torch < 2.1 has neither the device context, mmap loading nor assign
+            net = _build(arch, False, embedding_size)
+            net.load_state_dict(torch.load(model_path, map_location = 'cpu'))
+        print("load previous model parameters", model_path, "time", time.time() - time1)
+    else:
+        net = _build(arch, pretrained, embedding_size)
+        print("build", arch, "pretrained" if pretrained else "", "time", time.time() - time1)
+    return net
+
+
+def compile_model(net, enabled = True):
+    '''
+    forward function of net through torch.compile, falling back to eager when compilation fails
+    (compilation happens at the first call). net itself stays what is saved and optimized
+    mp3/sol.py and mp4/sol.py carry copies of it, each assignment folder runs on its own
+    '''
+    if not enabled:
+        return net
+    try:
+        compiled = torch.compile(net)
+    except Exception as e:
+        print("torch.compile unavailable, running eager:", e)
+        return net
+    state = {'forward': compiled}
+    def forward(*args):
+        if state['forward'] is not net:
+            try:
+                return state['forward'](*args)
+            except Exception as e:
+                print("torch.compile failed, running eager:", e)
+                state['forward'] = net
+        return net(*args)
+    return forward
@@ -0,0 +1,86 @@
+import os
+import sys, getopt
+import time
+import numpy as np
+from PIL import Image
+
+image_shape = (64, 64, 3)
+
+
+def pack(paths, names, prefix):
+    '''
+    decode every image once into one contiguous uint8 N x 64 x 64 x 3 array
+    rows are in sorted name order so a name finds its row with a binary search
+    '''
+    order = np.argsort(names)
+    names = np.array(names, dtype=np.bytes_)[order]
+    images = np.lib.format.open_memmap(prefix + '_images.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(names),) + image_shape)
+    time1 = time.time()
+    for row, i in enumerate(order):
+        images[row] = np.asarray(Image.open(paths[i]).convert('RGB'))
+        if row % 10000 == 9999:
+            print('packed', row + 1, 'of', len(names), time.time() - time1)
+    images.flush()
+    np.save(prefix + '_names.npy', names)
+    print('output', prefix, len(names), 'images')
+
+
+def pack_train(root, prefix):
+    paths = []
+    names = []
+    for label in sorted(os.listdir(root)):
+        image_dir = root + '/' + label + '/images'
+        for image in os.listdir(image_dir):
+            paths.append(image_dir + '/' + image)
+            names.append(image)
+    pack(paths, names, prefix)
+
+
+def pack_val(root, prefix):
+    names = sorted(os.listdir(root + '/images'))
+    pack([root + '/images/' + name for name in names], names, prefix)
+
+
+class PackedImages(object):
+    '''
+    name -> image lookup over a packed shard
+    the memmap is opened on first use, so every DataLoader worker maps the file itself
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.names = np.load(prefix + '_names.npy')
+        self.images = None
+
+    def row(self, name):
+        name = np.bytes_(name)
+        row = np.searchsorted(self.names, name)
+        if row == len(self.names) or self.names[row] != name:
+            raise KeyError('%s is not in %s' % (name.decode(), self.prefix))
+        return row
+
+    def get(self, name):
+        if self.images is None:
+            self.images = np.load(self.prefix + '_images.npy', mmap_mode='r')
+        return Image.fromarray(np.asarray(self.images[self.row(name)]))
+
+
+def main(argv):
+    root = 'tiny-imagenet-200'
+    out = 'tiny_packed'
+    try:
+        opts, args = getopt.getopt(argv, "", ["root=", "out="])
+    except getopt.GetoptError:
+        print('pack.py --root=tiny-imagenet-200 --out=tiny_packed')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--root":
+            root = arg
+        elif opt == "--out":
+            out = arg
+    pack_train(root + '/train', out + '_train')
+    pack_val(root + '/val', out + '_val')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+import time
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+
+class ProductQuantizer(object):
+    '''
+    compressed gallery: every vector is cut into m sub-vectors and each one is replaced by
+    the id of its nearest sub-centroid, so a 4096-d float32 row becomes m bytes
+    search is asymmetric: the exact query is compared with the quantized gallery through
+    per-query distance tables; the rerank best candidates can be re-scored with the exact
+    gallery vectors (self.gallery, usually the memmapped embedding file)
+    '''
+    def __init__(self, m=32, nbits=8, rerank=0):
+        self.m = m
+        self.ksub = 2 ** nbits
+        self.rerank = rerank
+        self.codebooks = None
+        self.codes = None
+        self.gallery = None
+
+    def train(self, X, train_size=20000, seed=0):
+        time1 = time.time()
+        rng = np.random.RandomState(seed)
+        sample = np.asarray(X[np.sort(rng.choice(len(X), min(train_size, len(X)), replace=False))], dtype=np.float32)
+        if sample.shape[1] % self.m:
+            raise ValueError('dimension %d is not a multiple of m = %d' % (sample.shape[1], self.m))
+        dsub = sample.shape[1] // self.m
+        self.codebooks = np.empty((self.m, self.ksub, dsub), dtype=np.float32)
+        for j in range(self.m):
+            kmeans = MiniBatchKMeans(n_clusters=self.ksub, batch_size=4096, n_init=3, random_state=seed)
+            kmeans.fit(sample[:, j * dsub:(j + 1) * dsub])
+            self.codebooks[j] = kmeans.cluster_centers_
+        print("train product quantizer", time.time() - time1)
+        return self
+
+    def encode(self, X, block_size=8192):
+        dsub = self.codebooks.shape[2]
+        c_sq = np.einsum('jkd,jkd->jk', self.codebooks, self.codebooks)
+        codes = np.empty((len(X), self.m), dtype=np.uint8 if self.ksub <= 256 else np.uint16)
+        for start in range(0, len(X), block_size):
+            x = np.asarray(X[start:start + block_size], dtype=np.float32)
+            for j in range(self.m):
+                d = c_sq[j][None, :] - 2 * x[:, j * dsub:(j + 1) * dsub].dot(self.codebooks[j].T)
+                codes[start:start + len(x), j] = d.argmin(1)
+        return codes
+
+    def fit(self, X):
+        self.train(X)
+        time1 = time.time()
+        self.codes = self.encode(X)
+        print("encode gallery", time.time() - time1, self.codes.nbytes, "bytes")
+        return self
+
+    def _tables(self, X):
+        # (num_query, m, ksub) squared distances from every query sub-vector to every sub-centroid
+        dsub = self.codebooks.shape[2]
+        x = X.reshape(len(X), self.m, dsub)
+        return (np.einsum('qjd,qjd->qj', x, x)[:, :, None] - 2 * np.einsum('qjd,jkd->qjk', x, self.codebooks)
+                + np.einsum('jkd,jkd->jk', self.codebooks, self.codebooks)[None])
+
+    def kneighbors(self, X, n_neighbors=5, query_block=256):
+        '''
+        same return value as sklearn kneighbors: (distances, indices), sorted
+        '''
+        X = np.asarray(X, dtype=np.float32)
+        rerank = self.rerank if self.gallery is not None else 0
+        num_candidate = min(max(n_neighbors, rerank), len(self.codes))
+        distances = np.empty((len(X), n_neighbors), dtype=np.float32)
+        indices = np.empty((len(X), n_neighbors), dtype=np.int64)
+        for start in range(0, len(X), query_block):
+            x = X[start:start + query_block]
+            tables = self._tables(x)
+            d = np.zeros((len(x), len(self.codes)), dtype=np.float32)
+            for j in range(self.m):
+                d += tables[:, j, self.codes[:, j]]
+            cand = np.argpartition(d, num_candidate - 1, axis=1)[:, :num_candidate]
+            if rerank:
+                # exact distances for the shortlist, read row by row from the gallery
+                rows = np.unique(cand)
+                vectors = np.asarray(self.gallery[rows], dtype=np.float32)
+                pos = np.searchsorted(rows, cand)
+                cand_d = np.empty(cand.shape, dtype=np.float32)
+                for q in range(0, len(x), 16):
+                    diff = vectors[pos[q:q + 16]] - x[q:q + 16, None, :]
+                    cand_d[q:q + 16] = np.einsum('qcd,qcd->qc', diff, diff)
+            else:
+                cand_d = np.take_along_axis(d, cand, 1)
+            top = np.argsort(cand_d, axis=1)[:, :n_neighbors]
+            distances[start:start + len(x)] = np.sqrt(np.maximum(np.take_along_axis(cand_d, top, 1), 0))
+            indices[start:start + len(x)] = np.take_along_axis(cand, top, 1)
+        return distances, indices
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, codebooks=self.codebooks, codes=self.codes, rerank=self.rerank)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(m=data['codebooks'].shape[0], rerank=int(data['rerank']))
+        index.ksub = data['codebooks'].shape[1]
+        index.codebooks = data['codebooks']
+        index.codes = data['codes']
+        return index
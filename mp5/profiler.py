@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import resource
+import torch
+
+stages = ('data', 'h2d', 'forward', 'loss', 'backward', 'optimizer', 'other')
+
+
+class StepProfiler(object):
+    '''
+    splits every training step into stages: the loop calls mark('data') once the batch is there,
+    mark('h2d') after the copy to the device, then 'forward', 'loss', 'backward', 'optimizer',
+    and step(batch_size) at the end (the rest of the step is 'other')
+    every `every` steps one JSON line goes to path: mean ms per stage, samples/s and peak RSS
+    trace = (first, last) records steps first..last with torch.profiler into trace_dir
+    a disabled profiler (no path, no trace) does nothing, cuda is only synchronized when enabled
+    mp3/, mp4/ and mp5/ carry the same file, each assignment folder runs on its own: keep them identical
+    '''
+    def __init__(self, path = None, every = 50, device = None, trace = None, trace_dir = 'trace'):
+        self.path = path
+        self.every = every
+        self.sync = device is not None and torch.device(device).type == 'cuda'
+        self.trace = trace
+        self.trace_dir = trace_dir
+        self.enabled = bool(path or trace)
+        self.file = open(path, 'a') if path else None
+        self.profile = None
+        self.num_step = 0
+        self.epoch = 0
+        self.reset()
+
+    def reset(self):
+        self.total = dict((stage, 0.0) for stage in stages)
+        self.samples = 0
+        self.steps = 0
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.time()
+
+    def start(self, epoch = 0):
+        # call before iterating the loader: the data stage starts here
+        self.epoch = epoch
+        if self.enabled:
+            self.trace_step()
+            self.last = self.now()
+
+    def mark(self, stage):
+        if self.enabled:
+            now = self.now()
+            self.total[stage] += now - self.last
+            self.last = now
+
+    def step(self, samples):
+        if not self.enabled:
+            return
+        self.mark('other')
+        self.num_step += 1
+        self.steps += 1
+        self.samples += samples
+        if self.file is not None and self.steps >= self.every:
+            self.write()
+        self.trace_step()
+        # the stages after step() belong to the next step
+        self.last = self.now()
+
+    def write(self):
+        seconds = sum(self.total.values())
+        record = {'epoch': self.epoch, 'step': self.num_step, 'steps': self.steps,
+                  'ms': dict((stage, self.total[stage] / self.steps * 1000) for stage in stages),
+                  'step_ms': seconds / self.steps * 1000,
+                  'samples_s': self.samples / seconds,
+                  'data_fraction': self.total['data'] / seconds,
+                  # ru_maxrss is in kB on linux
+                  'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+                  'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.}
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.reset()
+
+    def trace_step(self):
+        if not self.trace:
+            return
+        first, last = self.trace
+        if self.num_step == first and self.profile is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.sync:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profile = torch.profiler.profile(activities = activities, record_shapes = True, profile_memory = True)
+            self.profile.__enter__()
+        elif self.num_step == last + 1 and self.profile is not None:
+            self.profile.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok = True)
+            path = os.path.join(self.trace_dir, 'trace_%d_%d.json' % (first, last))
+            self.profile.export_chrome_trace(path)
+            print("write profiler trace", path)
+            self.profile = None
+            self.trace = None
+
+    def close(self):
+        if self.file is not None:
+            if self.steps:
+                self.write()
+            self.file.close()
+            self.file = None
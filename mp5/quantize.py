@@ -0,0 +1,137 @@
+import time
+import sys, getopt
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from torch.utils.data import Subset
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from model import build_embedder
+from gallery import GalleryDataset
+from sampler import ClassIndex
+from sol import TripleDataset
+from knn import TorchKNN
+from embedding_store import open_embedding
+from metrics import retrieval_metrics
+
+transform = transforms.Compose(
+    [transforms.Resize((224,224)),
+     transforms.ToTensor(),
+     transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+
+
+def _prepare(net):
+    # fx graph mode: observers after every conv/linear, per-channel int8 weights for the x86 backend
+    engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+    torch.backends.quantized.engine = engine
+    net.eval()
+    return prepare_fx(net, get_default_qconfig_mapping(engine), (torch.randn(1, 3, 224, 224),))
+
+
+def quantize_embedder(net, loader):
+    '''
+    post-training static quantization: the observers record activation ranges over loader,
+    then conv/linear/relu are converted to int8 kernels
+    '''
+    prepared = _prepare(net)
+    time1 = time.time()
+    with torch.inference_mode():
+        for images in loader:
+            prepared(images)
+    print("calibrate", len(loader.dataset), "images", time.time() - time1)
+    return convert_fx(prepared)
+
+
+def load_quantized(path = 'model_int8.pt'):
+    # same graph as quantize_embedder without calibration, the int8 weights and scales come from the file
+    net = convert_fx(_prepare(build_embedder(None, pretrained = False)))
+    net.load_state_dict(torch.load(path, map_location = 'cpu'))
+    print("load int8 model", path)
+    return net
+
+
+def embed(net, loader):
+    # embeddings, labels and seconds per image of one pass over loader (cpu, batch as given)
+    outputs, labels = [], []
+    seconds = 0.0
+    with torch.inference_mode():
+        for images, label in loader:
+            time1 = time.time()
+            outputs.append(net(images).float().numpy())
+            seconds += time.time() - time1
+            labels.extend(label)
+    return np.concatenate(outputs), labels, seconds / len(loader.dataset)
+
+
+def report(fp32, int8, loader, embedding_array, train_image_name, k = 30):
+    '''
+    top-k retrieval of the fp32 and int8 query embeddings against the fp32 gallery, plus latency
+    '''
+    gallery = open_embedding(embedding_array)
+    gallery_labels = np.load(open(train_image_name, 'rb'))
+    k = min(k, len(gallery))
+    neigh = TorchKNN(n_neighbors = k).fit(gallery)
+    results = {}
+    for name, net in (('fp32', fp32), ('int8', int8)):
+        output, labels, latency = embed(net, loader)
+        indices = neigh.kneighbors(output, k)[1]
+        results[name] = (output, retrieval_metrics(indices, gallery_labels, labels), latency)
+    cosine = np.sum(results['fp32'][0] * results['int8'][0], 1) / (
+        np.linalg.norm(results['fp32'][0], axis = 1) * np.linalg.norm(results['int8'][0], axis = 1))
+    columns = [key for key in results['fp32'][1] if key.startswith('precision@') or key == 'mAP']
+    print("%-6s" % "model", " ".join("%12s" % key for key in columns), "%12s" % "ms / image")
+    for name, (output, metrics, latency) in results.items():
+        print("%-6s" % name, " ".join("%12.4f" % metrics[key] for key in columns), "%12.2f" % (latency * 1000))
+    print("speedup %.2f, mean cosine fp32 / int8 embedding %.4f" % (results['fp32'][2] / results['int8'][2], cosine.mean()))
+
+
+def main(argv):
+    model_path = 'model.pt'
+    out = 'model_int8.pt'
+    calibration_images = 1024
+    report_images = None
+    batch_size = 32
+    packed = None
+    try:
+        opts, args = getopt.getopt(argv, "", ["model=", "out=", "calibration_images=", "report_images=",
+                                              "batch_size=", "packed="])
+    except getopt.GetoptError:
+        print('quantize.py --model=model.pt --out=model_int8.pt --calibration_images=1024 --report_images=N --packed=tiny_packed')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--model":
+            model_path = arg
+        elif opt == "--out":
+            out = arg
+        elif opt == "--calibration_images":
+            calibration_images = int(arg)
+        elif opt == "--report_images":
+            report_images = int(arg)
+        elif opt == "--batch_size":
+            batch_size = int(arg)
+        elif opt == "--packed":
+            packed = arg
+    torch.manual_seed(0)
+    fp32 = build_embedder(model_path, pretrained = False)
+    fp32.eval()
+
+    # calibration slice: a fixed random sample of the training images
+    index = ClassIndex.from_tree('tiny-imagenet-200/train')
+    rows = np.sort(np.random.RandomState(0).choice(len(index), min(calibration_images, len(index)), replace = False))
+    calibset = Subset(GalleryDataset(index, 'tiny-imagenet-200/train', transform, packed + '_train' if packed else None), rows)
+    calibloader = torch.utils.data.DataLoader(calibset, batch_size = batch_size, num_workers = 4)
+    # a second copy: prepare_fx fuses conv and batchnorm of the module it is given
+    int8 = quantize_embedder(build_embedder(model_path, pretrained = False), calibloader)
+    torch.save(int8.state_dict(), out)
+    print("save int8 model", out)
+
+    testset = TripleDataset(triplelist = 'testlist.pkl', root_dir = 'tiny-imagenet-200/val/images/', train = 0,
+                            transform = transform, packed = packed + '_val' if packed else None)
+    if report_images:
+        testset = Subset(testset, range(min(report_images, len(testset))))
+    testloader = torch.utils.data.DataLoader(testset, batch_size = batch_size, num_workers = 4)
+    report(fp32, int8, testloader, 'embedding.pkl', 'train_image_name.pkl')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
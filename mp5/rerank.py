@@ -0,0 +1,65 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def _local_distances(queries, vectors):
+    # (b, K + 1, K + 1) squared l2 distances among every query (row 0) and its K candidates
+    x = torch.cat((queries[:, None], vectors), 1)
+    sq = (x * x).sum(-1)
+    return (sq[:, :, None] + sq[:, None, :] - 2 * torch.bmm(x, x.transpose(1, 2))).clamp_(min = 0)
+
+
+def _reciprocal(rank, k):
+    # [b, i, j]: j is among the k nearest of i (besides i) and i among the k nearest of j
+    near = rank <= k
+    return near & near.transpose(1, 2)
+
+
+def k_reciprocal_rerank(queries, gallery, indices, k1 = 20, k2 = 6, lambda_value = 0.3, metric = 'l2', query_block = 64):
+    '''
+    k-reciprocal re-ranking (Zhong et al. 2017) of the candidate lists indices (num_query, K)
+    the neighbour graph is the one among each query and its own K candidates, so the cost is
+    O(K^2) per query whatever the gallery size, and every step is a batched (b, K + 1, K + 1) tensor op
+    k1: reciprocal neighbourhood, k2: local query expansion, lambda_value: weight of the original distance
+    -1 candidates (padding of approximate indexes) stay out of the neighbour graph and are ranked last
+    returns (distances, indices) of the candidates in the new order
+    '''
+    indices = np.asarray(indices)
+    distances = np.empty(indices.shape, dtype = np.float32)
+    reranked = np.empty_like(indices)
+    for start in range(0, len(indices), query_block):
+        cand = indices[start:start + query_block]
+        q = torch.from_numpy(np.asarray(queries[start:start + query_block], dtype = np.float32))
+        v = torch.from_numpy(np.asarray(gallery[np.maximum(cand, 0).ravel()], dtype = np.float32)).reshape(cand.shape + (-1,))
+        if metric == 'cosine':
+            q, v = F.normalize(q, dim = -1), F.normalize(v, dim = -1)
+        # the -1 padding of approximate indexes is no neighbour of anything
+        valid = torch.from_numpy(np.concatenate((np.ones((len(cand), 1), dtype = bool), cand >= 0), 1))
+        pair = valid[:, :, None] & valid[:, None, :]
+        dist = _local_distances(q, v).masked_fill_(~pair, 0)
+        dist = dist / dist.max(-1, keepdim = True).values.clamp_(min = 1e-12)
+        dist.masked_fill_(~pair, float('inf'))
+        # rank[b, i, j]: position of j in the neighbour list of i, 0 is i itself
+        rank = dist.argsort(-1).argsort(-1)
+        reciprocal = _reciprocal(rank, k1) & pair
+        half = (_reciprocal(rank, int(round(k1 / 2))) & pair).float()
+        # expansion: the half size set of a reciprocal neighbour j joins when 2/3 of it is already in
+        overlap = torch.bmm(reciprocal.float(), half.transpose(1, 2))
+        join = reciprocal & (overlap > 2. / 3 * half.sum(-1)[:, None, :])
+        expanded = reciprocal | (torch.bmm(join.float(), half) > 0)
+        weight = expanded * torch.exp(-dist)
+        weight = weight / weight.sum(-1, keepdim = True).clamp_(min = 1e-12)
+        if k2 > 1:
+            # every row becomes the mean of the rows of its k2 nearest (itself included)
+            local = ((rank < k2) & pair).float()
+            weight = torch.bmm(local, weight) / local.sum(-1, keepdim = True).clamp_(min = 1)
+        # jaccard distance between the query row and every candidate row
+        jaccard = 1 - (torch.minimum(weight[:, :1], weight[:, 1:]).sum(-1)
+                       / torch.maximum(weight[:, :1], weight[:, 1:]).sum(-1))
+        final = (1 - lambda_value) * jaccard + lambda_value * dist[:, 0, 1:]
+        final[torch.from_numpy(cand < 0)] = float('inf')
+        order = final.argsort(-1)
+        distances[start:start + len(cand)] = torch.gather(final, 1, order).numpy()
+        reranked[start:start + len(cand)] = np.take_along_axis(cand, order.numpy(), 1)
+    return distances, reranked
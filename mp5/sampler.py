@@ -0,0 +1,126 @@
+import os
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class ClassIndex(object):
+    '''
+    every training image once, grouped by class:
+    names[offsets[c]:offsets[c + 1]] are the images of classes[c]
+    '''
+    def __init__(self, names, counts, classes):
+        self.names = np.array(names, dtype=np.bytes_)
+        self.classes = np.asarray(classes)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        self.label_ids = np.repeat(np.arange(len(self.classes)), self.counts)
+
+    def __len__(self):
+        return len(self.names)
+
+    def name(self, i):
+        return self.names[i].decode()
+
+    def label(self, i):
+        return str(self.classes[self.label_ids[i]])
+
+    @classmethod
+    def from_tree(cls, root):
+        # one listdir per class, done once
+        classes = sorted(os.listdir(root))
+        names = []
+        counts = []
+        for label in classes:
+            images = sorted(os.listdir(root + '/' + label + '/images'))
+            names.extend(images)
+            counts.append(len(images))
+        return cls(names, counts, classes)
+
+
+class TripletSampler(Sampler):
+    '''
+    yields (query, positive, negative) rows of a ClassIndex, every image is the query once per epoch
+    positive: random image of the query class, negative: random image of a random other class
+    an epoch is drawn in one go with numpy from (seed, epoch), so it is reproducible
+    with world_size > 1 every rank draws the same epoch and keeps every world_size-th triplet
+    '''
+    def __init__(self, index, seed=0, rank=0, world_size=1):
+        self.index = index
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def triplets(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        index = self.index
+        num_image = len(index)
+        num_class = len(index.classes)
+        query = rng.permutation(num_image)
+        label = index.label_ids[query]
+        positive = index.offsets[label] + (rng.random(num_image) * index.counts[label]).astype(np.int64)
+        negative_label = (label + rng.integers(1, num_class, num_image)) % num_class
+        negative = index.offsets[negative_label] + (rng.random(num_image) * index.counts[negative_label]).astype(np.int64)
+        return np.stack((query, positive, negative), 1)
+
+    def __iter__(self):
+        # the same number of triplets on every rank, the remainder of the epoch is dropped
+        triplets = self.triplets()[self.rank:len(self) * self.world_size:self.world_size]
+        return iter([tuple(row) for row in triplets.tolist()])
+
+    def __len__(self):
+        return len(self.index) // self.world_size
+
+
+class PKBatchSampler(Sampler):
+    '''
+    batch sampler of p classes x k images for online triplet mining
+    every class is shuffled and cut into runs of k images (a remainder shorter than k is dropped);
+    round r takes run r of every class that has one, in a random class order, and cuts it into
+    batches of p runs, so a batch never mixes rounds and holds p distinct classes; the last runs of
+    a round that do not fill a batch are dropped, each kept image is embedded exactly once per epoch
+    the batches of all rounds are shuffled, with world_size > 1 they are dealt out to the ranks in turn
+    '''
+    def __init__(self, index, p, k, seed=0, rank=0, world_size=1):
+        self.index = index
+        self.p = p
+        self.k = k
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+        runs = index.counts // k
+        # round r has one run of every class with more than r runs
+        self.num_batches = int(sum((runs > r).sum() // p for r in range(runs.max(initial=0))))
+        self.num_samples = len(self) * p * k
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        index = self.index
+        label = index.label_ids
+        # images grouped by class, random order inside each class
+        order = np.lexsort((rng.random(len(index)), label))
+        run = (np.arange(len(index)) - index.offsets[label]) // self.k
+        keep = run < (index.counts // self.k)[label]
+        order, label, run = order[keep], label[keep], run[keep]
+        class_rank = rng.random((run.max(initial=0) + 1, len(index.classes)))
+        order = order[np.lexsort((class_rank[run, label], run))]
+        run = np.sort(run)
+        # position of every run inside its round, only whole groups of p runs are kept
+        slot = (np.arange(len(run)) - np.searchsorted(run, run)) // self.k
+        round_runs = np.bincount(run) // self.k
+        keep = slot < round_runs[run] // self.p * self.p
+        batches = order[keep].reshape(self.num_batches, self.p * self.k)
+        return batches[rng.permutation(self.num_batches)]
+
+    def __iter__(self):
+        return iter(self.batches()[self.rank:len(self) * self.world_size:self.world_size].tolist())
+
+    def __len__(self):
+        return self.num_batches // self.world_size
@@ -0,0 +1,51 @@
+from pathlib import Path
+from sklearn.neighbors import KNeighborsClassifier
+from ann import IVFIndex
+from pq import ProductQuantizer
+from knn import TorchKNN
+
+index_classes = {'ivf': IVFIndex, 'pq': ProductQuantizer}
+# sklearn's cosine distance is 1 - cosine similarity, as in knn.near_far_search
+sklearn_metrics = {'l2': 'euclidean', 'cosine': 'cosine'}
+
+
+def _index_shape(index):
+    # (rows, dim) of the gallery a loaded index was built from
+    if isinstance(index, IVFIndex):
+        return index.vectors.shape
+    return (len(index.codes), index.codebooks.shape[0] * index.codebooks.shape[2])
+
+
+def load_index(kind, embedding_array, train_image_name, n_neighbors, index_path = None, metric = 'l2', gallery_path = None):
+    # every index answers kneighbors(X, n_neighbors) like sklearn
+    # gallery_path: the file embedding_array came from, a cached index older than it is rebuilt
+    if kind == 'torch':
+        return TorchKNN(n_neighbors=n_neighbors, metric=metric).fit(embedding_array)
+    if kind in index_classes:
+        if metric != 'l2':
+            raise ValueError('%s index only supports metric l2, not %s' % (kind, metric))
+        # built once per gallery and kept next to it, e.g. ivf_index.npz
+        index_path = index_path or kind + '_index.npz'
+        index_file = Path(index_path)
+        index = None
+        if index_file.is_file() and (gallery_path is None or not Path(gallery_path).is_file() or
+                                     index_file.stat().st_mtime >= Path(gallery_path).stat().st_mtime):
+            index = index_classes[kind].load(index_path)
+            if tuple(_index_shape(index)) != tuple(embedding_array.shape):
+                print(kind, "index", index_path, "was built for a gallery of shape", tuple(_index_shape(index)), "rebuild")
+                index = None
+            else:
+                print("load", kind, "index")
+        if index is None:
+            index = index_classes[kind]().fit(embedding_array)
+            index.save(index_path)
+            print("save", kind, "index")
+        if kind == 'pq':
+            # exact vectors for re-ranking, memmapped so only the shortlisted rows are read
+            index.gallery = embedding_array
+        return index
+    if metric not in sklearn_metrics:
+        raise ValueError('unknown metric %s' % metric)
+    neigh = KNeighborsClassifier(n_neighbors=n_neighbors, n_jobs= -1, metric=sklearn_metrics[metric])
+    neigh.fit(embedding_array, train_image_name)
+    return neigh
@@ -0,0 +1,176 @@
+import io
+import json
+import time
+import queue
+import threading
+import sys, getopt
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from model import build_embedder
+from PIL import Image
+from embedding_store import open_embedding
+from search import load_index
+
+
+class Batcher(object):
+    '''
+    groups concurrent queries into one forward pass and one index search
+    a batch closes when it holds max_batch queries or max_wait seconds after its first query
+    '''
+    def __init__(self, net, device, neigh, names, max_batch = 32, max_wait = 0.01):
+        self.net = net
+        self.device = device
+        self.neigh = neigh
+        self.names = names
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def query(self, image, k):
+        # called from the request threads, blocks until the batch holding this query is done
+        request = {'image': image, 'k': k, 'done': threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout = timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.process(batch)
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            for request in batch:
+                request['done'].set()
+
+    def process(self, batch):
+        time1 = time.time()
+        images = torch.stack([request['image'] for request in batch]).to(self.device)
+        with torch.inference_mode():
+            outputs = self.net(images).float().cpu().numpy()
+        # one search per distinct k: a large k or a failing search only affects the requests that asked for it
+        for k in sorted(set(request['k'] for request in batch)):
+            rows = [i for i, request in enumerate(batch) if request['k'] == k]
+            try:
+                distances, indices = self.neigh.kneighbors(outputs[rows], k)
+            except Exception as e:
+                for i in rows:
+                    batch[i]['error'] = e
+                continue
+            for row, i in enumerate(rows):
+                keep = indices[row] >= 0
+                batch[i]['result'] = {'names': [str(self.names[j]) for j in indices[row][keep]],
+                                      'distances': distances[row][keep].tolist(),
+                                      'batch_size': len(batch),
+                                      'batch_time': time.time() - time1}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    POST /query?k=10 with the raw image file as body, 1 <= k <= gallery size,
+    answers {"names": [...train_image_name_real...], "distances": [...]}
+    '''
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/query':
+            self.send_error(404)
+            return
+        try:
+            k = int(parse_qs(url.query).get('k', ['10'])[0])
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            image = Image.open(io.BytesIO(body)).convert('RGB')
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+        if not 1 <= k <= len(self.server.batcher.names):
+            self.send_error(400, 'k must be between 1 and %d' % len(self.server.batcher.names))
+            return
+        try:
+            # decode and transform happen here, in parallel across request threads
+            result = self.server.batcher.query(self.server.transform(image), k)
+        except Exception as e:
+            self.send_error(500, type(e).__name__, str(e))
+            return
+        payload = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(model_path = 'model.pt', index = 'torch', nprobe = 8, rerank = 0, host = '127.0.0.1', port = 8000,
+          max_batch = 32, max_wait = 0.01):
+    # everything expensive happens once, before the first request
+    time1 = time.time()
+    net = build_embedder(model_path, pretrained = False)
+    if torch.cuda.is_available():
+        device = torch.device('cuda:0')
+    else:
+        device = torch.device('cpu')
+    net.to(device)
+    net.eval()
+
+    embedding_array = open_embedding('embedding.pkl')
+    train_image_name = np.load(open('train_image_name.pkl', 'rb'))
+    train_image_name_real = np.load(open('train_image_name_real.pkl', 'rb'))
+    neigh = load_index(index, embedding_array, train_image_name, 10, gallery_path = 'embedding.pkl')
+    if index == 'ivf':
+        neigh.nprobe = nprobe
+    elif index == 'pq':
+        neigh.rerank = rerank
+
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.batcher = Batcher(net, device, neigh, train_image_name_real, max_batch, max_wait)
+    server.transform = transforms.Compose(
+        [transforms.Resize((224,224)),
+         transforms.ToTensor(),
+         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+    print('serving on %s:%d' % (host, port), 'startup', time.time() - time1)
+    server.serve_forever()
+
+
+def main(argv):
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(argv, "", ["model=", "index=", "nprobe=", "rerank=", "host=", "port=",
+                                              "max_batch=", "max_wait_ms="])
+    except getopt.GetoptError:
+        print('serve.py --index=torch|ivf|pq --port=8000 --max_batch=32 --max_wait_ms=10')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--model":
+            kwargs['model_path'] = arg
+        elif opt == "--index":
+            kwargs['index'] = arg
+        elif opt in ("--nprobe", "--rerank", "--port", "--max_batch"):
+            kwargs[opt[2:]] = int(arg)
+        elif opt == "--host":
+            kwargs['host'] = arg
+        elif opt == "--max_wait_ms":
+            kwargs['max_wait'] = float(arg) / 1000
+    serve(**kwargs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,6 +15,14 @@ import torch.optim as optim
 import torchvision
 import torchvision.transforms as transforms
 from PIL import Image
+from pack import PackedImages
+from sampler import ClassIndex, TripletSampler, PKBatchSampler
+from mining import triplet_mining_loss
+from model import build_embedder, compile_model
+from checkpoint import CheckpointManager, rng_state, set_rng_state
+from distributed import init_distributed, rank_device, all_reduce, cleanup
+from profiler import StepProfiler
+from torch.nn.parallel import DistributedDataParallel
 import sys, getopt
 from torchvision import models as t_models
 
@@ -87,45 +95,73 @@ class ResNet(nn.Module):
         #x = self.fc(x)
         x = self.fc2(x)
         return x
-def choicelist(number, end):
-    ret = list(range(number)) + list(range(number + 1, end))
-    return ret
 
 class TripleDataset(Dataset):
-    def __init__(self,triplelist, root_dir,train, transform=None):
-        self.triplelist = pickle.load(open(triplelist,'rb'))
+    def __init__(self,triplelist, root_dir,train, transform=None, label_file = "testlist_label.pkl", packed = None):
+        if train:
+            # ClassIndex of the training tree, items are (query, positive, negative) rows from TripletSampler
+            self.triplelist = triplelist
+        else:
+            self.triplelist = pickle.load(open(triplelist,'rb'))
+            # evaluation index, loaded once: a fixed width path table and integer class ids.
+            # numpy arrays are shared by forked workers instead of being copied object by object
+            self.triplelist = np.array(self.triplelist, dtype=np.bytes_)
+            self.classes, self.label_ids = np.unique(pickle.load(open(label_file, 'rb')), return_inverse=True)
         self.root_dir = root_dir
         self.transform = transform
         self.train = train
+        # packed shard prefix from pack.py: images are served from one uint8 memmap instead of jpeg files
+        self.images = PackedImages(packed) if packed else None
 
     def __len__(self):
         return len(self.triplelist)
 
+    def load_image(self, path, name):
+        if self.images is not None:
+            return self.images.get(name)
+        return Image.open(path).convert('RGB')
+
     def __getitem__(self, idx):
         if self.train :
-            label = self.triplelist[idx][0].split('_')[0]
-            subdir = label
-            query_image_path = self.root_dir + '/'+ subdir + '/images/' + self.triplelist[idx][0]
-            positive_image_path = self.root_dir + '/'+ subdir + '/images/' + self.triplelist[idx][1]
-            negative_label = self.triplelist[idx][2].split('_')[0]
-            subdir = negative_label
-            negative_image_path = self.root_dir + '/'+ subdir + '/images/' + self.triplelist[idx][2]
-            positive_image = Image.open(positive_image_path).convert('RGB')
-            query_image = Image.open(query_image_path).convert('RGB')
-            negative_image = Image.open(negative_image_path).convert('RGB')
+            index = self.triplelist
+            query, positive, negative = idx
+            label = index.label(query)
+            query_name = index.name(query)
+            positive_name = index.name(positive)
+            negative_name = index.name(negative)
+            query_image_path = self.root_dir + '/'+ label + '/images/' + query_name
+            positive_image_path = self.root_dir + '/'+ label + '/images/' + positive_name
+            negative_image_path = self.root_dir + '/'+ index.label(negative) + '/images/' + negative_name
+            positive_image = self.load_image(positive_image_path, positive_name)
+            query_image = self.load_image(query_image_path, query_name)
+            negative_image = self.load_image(negative_image_path, negative_name)
             sample = {'positive_image': positive_image, 'query_image': query_image, 'negative_image' : negative_image}
-            label_ret = {'positive_label': label, 'name': self.triplelist[idx][0]}
+            label_ret = {'positive_label': label, 'name': query_name}
             if self.transform:
                 for i,v in sample.items():
                     sample[i] = self.transform(v)
             return sample, label_ret
         else:
-            query_image_path = self.root_dir + self.triplelist[idx]
-            label_list = pickle.load(open("testlist_label.pkl", 'rb'))
-            query_image = Image.open(query_image_path).convert('RGB')
+            name = self.triplelist[idx].decode()
+            label = str(self.classes[self.label_ids[idx]])
+            query_image_path = self.root_dir + name
+            query_image = self.load_image(query_image_path, name)
             if self.transform:
                 sample = self.transform(query_image)
-            return sample, label_list[idx]
+            return sample, label
+
+class ImageDataset(TripleDataset):
+    '''
+    single training images with integer class ids, batched by PKBatchSampler for online mining
+    '''
+    def __getitem__(self, idx):
+        index = self.triplelist
+        label = index.label(idx)
+        name = index.name(idx)
+        image = self.load_image(self.root_dir + '/'+ label + '/images/' + name, name)
+        if self.transform:
+            image = self.transform(image)
+        return image, {'positive_label': label, 'name': name, 'label_id': int(index.label_ids[idx])}
 
 def TestGenerator():
     root = "data/tiny-imagenet-200/val/images"
@@ -144,31 +180,6 @@ def TestGenerator():
         pickle.dump(image_list, f)
 
 
-def TripleGenerator():
-    num_ep = 40
-    for i in range(num_ep):
-        root = "data/tiny-imagenet-200/train"
-        label_list = os.listdir(root)
-        number_label = len(label_list)
-        triple_list = []
-        for ind, label in enumerate(label_list):
-            path = root + '/' + label + '/'+ 'images'
-            image_list = os.listdir(path)
-            number_image = len(image_list)
-            for image_inx, image in enumerate(image_list):
-                query_image = image
-                positive_image = image_list[np.random.choice(number_image)]
-                negative_index = np.random.choice(choicelist(ind, number_label))
-                negative_path = root + '/' + label_list[negative_index] + '/'+ 'images'
-                negative_image_list = os.listdir(negative_path)
-                number_negative_image = len(negative_image_list)
-                negative_image = negative_image_list[np.random.choice(number_negative_image)]
-                triple_list.append((query_image,positive_image,negative_image))
-        print(triple_list[0])
-        print(len(triple_list))
-        with open('triplelist' + str(i) + '.pkl', 'wb') as f:
-            pickle.dump(triple_list, f)
-
 class LimitedSizeDict(OrderedDict):
   def __init__(self, *args, **kwds):
     self.size_limit = kwds.pop("size_limit", None)
@@ -188,14 +199,43 @@ embedding_size =4096
 
 def main(pretrain,argv):
     batch_size = 64
+    packed = None
+    mining = None
+    images_per_class = 4
+    amp = None
+    channels_last = False
+    compile = False
+    profile = None
+    profile_every = 50
+    trace = None
     try:
-        opts,args = getopt.getopt(argv, "hb", ["batch_size="])
+        opts,args = getopt.getopt(argv, "hb", ["batch_size=", "packed=", "mining=", "images_per_class=", "amp=",
+                                               "channels_last", "compile", "profile=", "profile_every=", "trace="])
     except getopt.GetoptError:
         print('test.py -batch_size')
         sys.exit(2)
     for opt, arg in opts:
         if opt in ('-b', "--batch_size"):
             batch_size = int(arg)
+        elif opt == "--packed":
+            packed = arg + '_train'
+        elif opt == "--mining":
+            mining = arg
+        elif opt == "--images_per_class":
+            images_per_class = int(arg)
+        elif opt == "--amp":
+            amp = arg
+        elif opt == "--channels_last":
+            channels_last = True
+        elif opt == "--compile":
+            compile = True
+        elif opt == "--profile":
+            profile = arg
+        elif opt == "--profile_every":
+            profile_every = int(arg)
+        elif opt == "--trace":
+            trace = tuple(int(step) for step in arg.split(':'))
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
     print(batch_size)
     transform = transforms.Compose(
         [transforms.RandomHorizontalFlip(),
@@ -203,9 +243,8 @@ def main(pretrain,argv):
          transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
 
     if pretrain == True:
-        net = t_models.resnet101(pretrained = True)
-        num_inp = net.fc.in_features
-        net.fc = nn.Linear(num_inp, embedding_size)
+        # ImageNet weights only when there is no model.pt to resume from
+        net = build_embedder("model.pt", embedding_size = embedding_size)
 
         transform = transforms.Compose(
         [transforms.Resize((224,224)),
@@ -214,11 +253,11 @@ def main(pretrain,argv):
          transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
     else:
         net = ResNet()
-    #load previous model parameters
-    model_file = Path("model.pt")
-    if model_file.is_file():
-        net.load_state_dict(torch.load("model.pt"))
-        print("load previous model parameters")
+        #load previous model parameters
+        model_file = Path("model.pt")
+        if model_file.is_file():
+            net.load_state_dict(torch.load("model.pt"))
+            print("load previous model parameters")
     # child_counter = 0
     # for child in net.children():
     #     # print(child_counter)
@@ -242,38 +281,63 @@ def main(pretrain,argv):
     optimizer = optim.SGD(net.parameters(), lr = 0.001, momentum = 0.9)
 
     scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma = 0.99)
-    if torch.cuda.is_available():
-        print('cuda')
-        device = torch.device('cuda:0')
-    else:
-        print('cpu')
-        device = torch.device('cpu')
-    print(device)
-
-    net.to(device)
+    # one process per rank under torchrun, the gradients are averaged by DistributedDataParallel
+    rank, world_size = init_distributed()
+    device = rank_device()
+    print(device, 'rank', rank, 'of', world_size)
+
+    net.to(device, memory_format = memory_format)
+    model = compile_model(DistributedDataParallel(net) if world_size > 1 else net, compile)
+    # opt-in reduced precision: bf16 autocast (cpu or cuda), fp16 needs the gradient scaler on cuda
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[amp] if amp else None
+    if amp_dtype == torch.float16 and device.type != 'cuda':
+        # no gradient scaler off cuda, fp16 gradients would underflow unnoticed
+        print('--amp=fp16 needs cuda, training with bf16')
+        amp_dtype = torch.bfloat16
+    scaler = torch.amp.GradScaler('cuda', enabled = amp_dtype == torch.float16 and device.type == 'cuda')
     time1 = time.time()
     loss_list = []
-    loss_file = Path('loss_list.pkl')
-
-    for epoch in range(40):
+    start_epoch = 0
+    # the class index is built once, every epoch draws fresh triplets from it
+    train_index = ClassIndex.from_tree('tiny-imagenet-200/train')
+    if mining:
+        # batch_size // images_per_class classes x images_per_class images, triplets mined in the batch
+        train_sampler = PKBatchSampler(train_index, batch_size // images_per_class, images_per_class,
+                                       rank = rank, world_size = world_size)
+        trainset = ImageDataset(triplelist = train_index,root_dir = 'tiny-imagenet-200/train', train = 1, transform = transform,
+                                packed = packed)
+        trainloader = torch.utils.data.DataLoader(trainset, batch_sampler = train_sampler, num_workers = 4)
+    else:
+        train_sampler = TripletSampler(train_index, rank = rank, world_size = world_size)
+        trainset = TripleDataset(triplelist = train_index,root_dir = 'tiny-imagenet-200/train', train = 1, transform = transform,
+                                 packed = packed)
+        trainloader = torch.utils.data.DataLoader(trainset, batch_size = batch_size,
+                                                  sampler = train_sampler, num_workers = 4)
+
+    # resume exactly where the newest checkpoint stopped: weights, momentum, lr schedule, sampler and rngs
+    checkpoints = CheckpointManager('checkpoints', keep = 3)
+    state = checkpoints.load()
+    if state is not None:
+        net.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        if state.get('scaler') and scaler.is_enabled():
+            scaler.load_state_dict(state['scaler'])
+        train_sampler.seed = state['sampler_seed']
+        set_rng_state(state['rng'])
+        loss_list = state['loss_list']
+        start_epoch = state['epoch'] + 1
+        print("resume at epoch", start_epoch + 1, "last_loss:", loss_list[-1])
+        del state
+
+    # per stage step times of rank 0, see profiler.py
+    profiler = StepProfiler(profile if rank == 0 else None, profile_every, device, trace if rank == 0 else None)
+    for epoch in range(start_epoch, 40):
         scheduler.step()
-        if loss_file.is_file():
-            loss_list = pickle.load(open('loss_list.pkl', "rb"))
-
-            print("load loss list, epoch:", len(loss_list),"last_loss:", loss_list[len(loss_list) -2])
         net.train()
-        pickle_file = 'triplelist' + str(len(loss_list)) + '.pkl'
-
-        trainset = TripleDataset(triplelist = pickle_file,root_dir = 'tiny-imagenet-200/train', train = 1, transform = transform)
-        trainloader = torch.utils.data.DataLoader(trainset, batch_size = batch_size,
-                                                  shuffle=True, num_workers = 4)
+        train_sampler.set_epoch(epoch)
         time2 = time.time()
         running_loss = 0.0
-        train_embedding = None
-        train_image_name = None
-        train_embedding = []
-        train_image_name = []
-        train_image_name_real = []
         # if (epoch > 6):
         #     for group in optimizer.param_groups:
         #         for p in group['params']:
@@ -281,77 +345,76 @@ def main(pretrain,argv):
         #             if ('step' in state and state['step'] >= 1024):
         #                 state['step'] = 1000
         total_loss = 0
+        profiler.start(epoch)
         for i, data in enumerate(trainloader, 0):
             # get the inputs
             #print(len(image_dict))
             data_i , labels = data
-            positive_image = data_i['positive_image']
-            query_image = data_i['query_image']
-            negative_image =data_i['negative_image']
             label = labels['positive_label']
-            name = labels['name']
-            positive_image = positive_image.to(device)
-            negative_image = negative_image.to(device)
-            query_image = query_image.to(device)
+            profiler.mark('data')
             # zero the parameter gradients
             optimizer.zero_grad()
 
-            # forward + backward + optimize
-            query_output = None
-            positive_output = None
-            negative_output = None
-            query_output = net(query_image)
-            query_c = query_output.cpu()
-            del query_output
-            positive_output = net(positive_image)
-            positive_c = positive_output.cpu()
-            del positive_output
-            negative_output =  net(negative_image)
-            negative_c = negative_output.cpu()
-            del negative_output
-
-
-            loss = criterion(query_c, positive_c, negative_c)
-            if (epoch + 1) >= 1 and (epoch + 1) % 1 == 0:
-                for lable_len in range(len(label)):
-                    train_image_name.append(label[lable_len])
-                    train_embedding.append(query_c.data.numpy()[lable_len])
-                    train_image_name_real.append(name[lable_len])
-            loss.backward()
-            optimizer.step()
+            # forward + backward + optimize, the distances in the losses stay in float32
+            if mining:
+                # every image is embedded once, the triplets come from the batch distance matrix
+                images = data_i.to(device, memory_format = memory_format)
+                label_id = labels['label_id'].to(device)
+                profiler.mark('h2d')
+                with torch.autocast(device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+                    query_output = model(images)
+                profiler.mark('forward')
+                loss = triplet_mining_loss(query_output.float(), label_id, mining)
+            else:
+                positive_image = data_i['positive_image']
+                query_image = data_i['query_image']
+                negative_image =data_i['negative_image']
+                # one batch of 3 * B images: queries, then positives, then negatives
+                images = torch.cat((query_image, positive_image, negative_image), 0).to(device, memory_format = memory_format)
+                profiler.mark('h2d')
+                with torch.autocast(device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+                    outputs = model(images)
+                profiler.mark('forward')
+                query_output, positive_output, negative_output = torch.chunk(outputs.float(), 3, 0)
+                loss = criterion(query_output, positive_output, negative_output)
+            profiler.mark('loss')
+            scaler.scale(loss).backward()
+            profiler.mark('backward')
+            scaler.step(optimizer)
+            scaler.update()
+            profiler.mark('optimizer')
 
             # print statistics
             running_loss += loss.item()
             total_loss += running_loss
-            if i % len(label * 7) == len(label * 7)-1:  # print every 2000 mini-batches
+            if i % len(label * 7) == len(label * 7)-1 and rank == 0:  # print every 2000 mini-batches
                 print('[%d, %5d] loss: %.3f' %
                       (epoch + 1, i + 1, running_loss / len(label * 7)))
                 running_loss = 0.0
+            profiler.step(len(images))
 
                 #print('100 batch time: ', time.time() - time2)
             #progress_bar(i,len(trainloader))
         #save the model
-        loss = total_loss/(len(trainloader) * batch_size)
+        loss = all_reduce(torch.tensor(total_loss)).item() / world_size / (len(trainloader) * batch_size)
         loss_list.append(loss)
 
-        with open('loss_list.pkl', 'wb') as f:
-            pickle.dump(loss_list, f)
-            print("save loss")
-        torch.save(net.state_dict(), "model.pt")
-        print("save model")
-
-        train_embedding = np.asarray(train_embedding)
-        with open('embedding.pkl', 'wb') as f:
-            np.save(f, train_embedding)
-        print("output train embedding array")
-        train_image_name = np.asarray(train_image_name)
-        with open('train_image_name.pkl', 'wb') as f:
-            np.save(f, train_image_name)
-        print("output train_image_name")
-        with open('train_image_name_real.pkl', 'wb') as f:
-            np.save(f, train_image_name_real)
-        print("output train_image_name_real")
+        # every rank holds the same weights, only rank 0 writes
+        if rank == 0:
+            with open('loss_list.pkl', 'wb') as f:
+                pickle.dump(loss_list, f)
+                print("save loss")
+            # written in the background, model.pt keeps the weights for test.py / gallery.py
+            checkpoints.save({'model': net.state_dict(), 'optimizer': optimizer.state_dict(),
+                              'scheduler': scheduler.state_dict(), 'scaler': scaler.state_dict(), 'sampler_seed': train_sampler.seed,
+                              'rng': rng_state(), 'loss_list': loss_list, 'epoch': epoch},
+                             epoch, exports = {'model.pt': 'model'})
+            print("save model")
+        # the gallery is built separately from the saved model: python gallery.py
            # test('embedding.pkl', 'train_image_name.pkl')
+    checkpoints.close()
+    profiler.close()
+    cleanup()
     print('Total time: ', time.time() -time1)
     print('Finished Training')
     print('Start Testing')
@@ -435,6 +498,7 @@ def test(embedding_array,train_image_name):
     print("average acc of testing: ", (accuracy)/10000)
     print('One time: ', time.time()- time3)
 
-main(True,sys.argv[1:])
+if __name__ == '__main__':
+    main(True,sys.argv[1:])
 #TestGenerator()
 #test('embedding.pkl', 'train_image_name.pkl')
@@ -6,6 +6,14 @@ from scipy import spatial
 from sklearn.neighbors import KNeighborsClassifier
 import os
 from utils import progress_bar
+from ann import recall_at_k
+from knn import near_far_search
+from search import load_index
+from model import build_embedder
+from quantize import load_quantized
+from rerank import k_reciprocal_rerank
+from embedding_store import open_embedding
+from metrics import retrieval_metrics, print_metrics
 from pathlib import Path
 from collections import OrderedDict
 from torch.utils.data import Dataset
@@ -15,19 +23,32 @@ import torch.optim as optim
 import torchvision
 import torchvision.transforms as transforms
 from PIL import Image
+from pack import PackedImages
 import sys, getopt
 from torchvision import models as t_models
 
 class TripleDataset(Dataset):
-    def __init__(self,triplelist, root_dir,train, transform=None):
+    def __init__(self,triplelist, root_dir,train, transform=None, label_file = "testlist_label.pkl", packed = None):
         self.triplelist = pickle.load(open(triplelist,'rb'))
+        if not train:
+            # evaluation index, loaded once: a fixed width path table and integer class ids.
+            # numpy arrays are shared by forked workers instead of being copied object by object
+            self.triplelist = np.array(self.triplelist, dtype=np.bytes_)
+            self.classes, self.label_ids = np.unique(pickle.load(open(label_file, 'rb')), return_inverse=True)
         self.root_dir = root_dir
         self.transform = transform
         self.train = train
+        # packed shard prefix from pack.py: images are served from one uint8 memmap instead of jpeg files
+        self.images = PackedImages(packed) if packed else None
 
     def __len__(self):
         return len(self.triplelist)
 
+    def load_image(self, path, name):
+        if self.images is not None:
+            return self.images.get(name)
+        return Image.open(path).convert('RGB')
+
     def __getitem__(self, idx):
         if self.train :
             label = self.triplelist[idx][0].split('_')[0]
@@ -37,66 +58,78 @@ class TripleDataset(Dataset):
             negative_label = self.triplelist[idx][2].split('_')[0]
             subdir = negative_label
             negative_image_path = self.root_dir + '/'+ subdir + '/images/' + self.triplelist[idx][2]
-            positive_image = Image.open(positive_image_path).convert('RGB')
-            query_image = Image.open(query_image_path).convert('RGB')
-            negative_image = Image.open(negative_image_path).convert('RGB')
+            positive_image = self.load_image(positive_image_path, self.triplelist[idx][1])
+            query_image = self.load_image(query_image_path, self.triplelist[idx][0])
+            negative_image = self.load_image(negative_image_path, self.triplelist[idx][2])
             sample = {'positive_image': positive_image, 'query_image': query_image, 'negative_image' : negative_image}
             if self.transform:
                 for i,v in sample.items():
                     sample[i] = self.transform(v)
             return sample, self.triplelist[idx]
         else:
-            query_image_path = self.root_dir + self.triplelist[idx]
-            label_list = pickle.load(open("testlist_label.pkl", 'rb'))
-            query_image = Image.open(query_image_path).convert('RGB')
+            name = self.triplelist[idx].decode()
+            label = str(self.classes[self.label_ids[idx]])
+            query_image_path = self.root_dir + name
+            query_image = self.load_image(query_image_path, name)
             if self.transform:
                 sample = self.transform(query_image)
-            return sample, label_list[idx], self.triplelist[idx]
+            return sample, label, name
+
+def report_recall(embedding_array, train_image_name, test_output, indices, n_neighbors, recall_queries):
+    # recall of an approximate index against exact search on the first recall_queries queries
+    time_recall = time.time()
+    exact = load_index('torch', embedding_array, train_image_name, n_neighbors)
+    exact_out = exact.kneighbors(test_output[:recall_queries], n_neighbors)
+    print("recall@%d against exact search: %.4f" % (n_neighbors, recall_at_k(indices[:recall_queries], exact_out[1], n_neighbors)),
+          "time", time.time() - time_recall)
 
-def test(embedding_array,train_image_name):
+def test(embedding_array,train_image_name, index = 'exact', nprobe = 8, recall_queries = 1000, metric = 'l2', packed = None, rerank = 0, amp = None, quantized = None,
+         k_reciprocal = 0):
     embedding_size = 4096
     transform = transforms.Compose(
         [transforms.Resize((224,224)),
          transforms.ToTensor(),
          transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
-    net = t_models.resnet101(pretrained=True)
-    num_inp = net.fc.in_features
-    net.fc = nn.Linear(num_inp, embedding_size)
-    model_file = Path("model.pt")
-    if model_file.is_file():
-        net.load_state_dict(torch.load("model.pt"))
-        print("load previous model parameters")
-    if torch.cuda.is_available():
-        print('cuda')
-        device = torch.device('cuda:0')
-    else:
-        print('cpu')
+    if quantized:
+        # int8 model written by quantize.py, runs on cpu only
+        net = load_quantized(quantized)
         device = torch.device('cpu')
+    else:
+        net = build_embedder("model.pt", embedding_size = embedding_size, pretrained = False)
+        if torch.cuda.is_available():
+            print('cuda')
+            device = torch.device('cuda:0')
+        else:
+            print('cpu')
+            device = torch.device('cpu')
 
     net.to(device)
+    # amp = 'bf16' / 'fp16' embeds the queries under autocast, the search stays float32
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[amp] if amp else None
 
-    embedding_array = np.load(embedding_array)
+    gallery_path = embedding_array
+    embedding_array = open_embedding(gallery_path)
     print(embedding_array.shape, "embedding array shape")
     train_image_name = np.load(open(train_image_name, 'rb'))
     print(len(train_image_name), "image_label_length")
     time3 = time.time()
     net.eval()
     testset = TripleDataset(triplelist = 'testlist.pkl', root_dir = 'tiny-imagenet-200/val/images/', train = 0,
-                             transform = transform)
+                             transform = transform, packed = packed + '_val' if packed else None)
     testloader = torch.utils.data.DataLoader(testset, batch_size= 24,shuffle=True, num_workers = 4)
     #label_list = pickle.load(open("testlist_label.pkl", 'rb'))
     #tree_array = np.vstack((outputs, embedding_array))
-    neigh = KNeighborsClassifier(n_neighbors=30, n_jobs= -1 )
 
     test_output =[]
     test_label = []
     for i, data in enumerate(testloader, 0):
         # get the inputs
-        inputs, labels = data
+        inputs, labels, test_name = data
 
         inputs = inputs.to(device)
-        outputs = net(inputs)
-        outputs_c = outputs.cpu().data.numpy()
+        with torch.autocast(device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+            outputs = net(inputs)
+        outputs_c = outputs.float().cpu().data.numpy()
         del outputs
         #print(outputs_c.shape)
         for s_label in range(outputs_c.shape[0]):
@@ -105,52 +138,64 @@ def test(embedding_array,train_image_name):
         progress_bar(i, len(testloader))
     time_fit = time.time()
     print("begin to fit the model")
-    neigh.fit(embedding_array, train_image_name)
+    neigh = load_index(index, embedding_array, train_image_name, 30, metric = metric, gallery_path = gallery_path)
     print("finish_fitting",time.time() - time_fit)
     time_fit = time.time()
     print("begin to predict")
     test_output = np.asarray(test_output)
-    predict_out = neigh.kneighbors(test_output)
+    if index == 'ivf':
+        neigh.nprobe = nprobe
+    elif index == 'pq':
+        neigh.rerank = rerank
+    # k_reciprocal > 0: the top max(30, k_reciprocal) candidates per query are re-ranked afterwards
+    predict_out = neigh.kneighbors(test_output, max(30, k_reciprocal))
+    candidates = predict_out[1]
+    predict_out = (predict_out[0][:, :30], predict_out[1][:, :30])
     print("finish predict", time.time() - time_fit)
-    count = 0
-    for i, data in enumerate(predict_out[1]):
-        test_array = np.repeat(test_label[i], 30, axis = 0)
-        #print(data.shape)
-        labellist = []
-        for data_i in data:
-            labellist.append(train_image_name[data_i])
-        labellist = np.asarray(labellist)
-        #print(labellist)
-        #print(test_array)
-        count += np.sum(labellist == test_array)
-        progress_bar(i, len(predict_out[1]))
-    print("average acc of testing: ", (count)* 100 /(len(predict_out[1])*30))#test_output.shape[0])
+    if index not in ('exact', 'torch'):
+        report_recall(embedding_array, train_image_name, test_output, predict_out[1], 30, recall_queries)
+    metrics = retrieval_metrics(predict_out[1], train_image_name, test_label)
+    print_metrics(metrics)
+    if k_reciprocal:
+        time_rerank = time.time()
+        reranked = k_reciprocal_rerank(test_output, embedding_array, candidates, metric = metric)[1][:, :30]
+        time_rerank = time.time() - time_rerank
+        rerank_metrics = retrieval_metrics(reranked, train_image_name, test_label)
+        print("k-reciprocal re-ranking of the top", candidates.shape[1], "time", time_rerank,
+              "(%.3f ms / query)" % (time_rerank * 1000 / len(test_output)))
+        for key in metrics:
+            if key != 'per_class':
+                print("%-14s %.4f -> %.4f (%+.4f)" % (key, metrics[key], rerank_metrics[key], rerank_metrics[key] - metrics[key]))
+        metrics = rerank_metrics
+    print("average acc of testing: ", metrics['precision@30'] * 100)
     print('One time: ', time.time()- time3)
 
-def validate(embedding_array,train_image_name):
+def validate(embedding_array,train_image_name, index = 'exact', nprobe = 8, metric = 'l2', num_batches = 1, packed = None, rerank = 0, amp = None, quantized = None):
     name_path = 'train_image_name_real.pkl'
     embedding_size = 4096
     transform = transforms.Compose(
         [transforms.Resize((224,224)),
          transforms.ToTensor(),
          transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
-    net = t_models.resnet101(pretrained=True)
-    num_inp = net.fc.in_features
-    net.fc = nn.Linear(num_inp, embedding_size)
-    model_file = Path("model.pt")
-    if model_file.is_file():
-        net.load_state_dict(torch.load("model.pt"))
-        print("load previous model parameters")
-    if torch.cuda.is_available():
-        print('cuda')
-        device = torch.device('cuda:0')
-    else:
-        print('cpu')
+    if quantized:
+        # int8 model written by quantize.py, runs on cpu only
+        net = load_quantized(quantized)
         device = torch.device('cpu')
+    else:
+        net = build_embedder("model.pt", embedding_size = embedding_size, pretrained = False)
+        if torch.cuda.is_available():
+            print('cuda')
+            device = torch.device('cuda:0')
+        else:
+            print('cpu')
+            device = torch.device('cpu')
 
     net.to(device)
+    # amp = 'bf16' / 'fp16' embeds the queries under autocast, the search stays float32
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[amp] if amp else None
 
-    embedding_array = np.load(embedding_array)
+    gallery_path = embedding_array
+    embedding_array = open_embedding(gallery_path)
     print(embedding_array.shape, "embedding array shape")
     train_image_name = np.load(open(train_image_name, 'rb'))
     train_image_name_real  = np.load(open(name_path, 'rb'))
@@ -159,11 +204,10 @@ def validate(embedding_array,train_image_name):
     time3 = time.time()
     net.eval()
     testset = TripleDataset(triplelist = 'testlist.pkl', root_dir = 'tiny-imagenet-200/val/images/', train = 0,
-                             transform = transform)
+                             transform = transform, packed = packed + '_val' if packed else None)
     testloader = torch.utils.data.DataLoader(testset, batch_size= 5,shuffle=True, num_workers = 4)
     #label_list = pickle.load(open("testlist_label.pkl", 'rb'))
     #tree_array = np.vstack((outputs, embedding_array))
-    neigh = KNeighborsClassifier(n_neighbors=10, n_jobs= -1 )
 
     test_output =[]
     test_label = []
@@ -173,28 +217,37 @@ def validate(embedding_array,train_image_name):
         inputs, labels , test_name= data
 
         inputs = inputs.to(device)
-        outputs = net(inputs)
-        outputs_c = outputs.cpu().data.numpy()
+        with torch.autocast(device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+            outputs = net(inputs)
+        outputs_c = outputs.float().cpu().data.numpy()
         del outputs
         #print(outputs_c.shape)
         for s_label in range(outputs_c.shape[0]):
             test_output.append(outputs_c[s_label])
             test_label.append(labels[s_label])
             test_name_list.append(test_name[s_label])
-        break
-    time_fit = time.time()
-    print("begin to fit the model")
-    neigh.fit(embedding_array, train_image_name)
-    print("finish_fitting",time.time() - time_fit)
+        if i + 1 >= num_batches:
+            break
     time_fit = time.time()
     print("begin to predict")
     test_output = np.asarray(test_output)
-    predict_out = neigh.kneighbors(test_output)
+    if index in ('exact', 'torch'):
+        # nearest ten and farthest ten (farthest first) from one pass over the gallery
+        predict_out, predict_out_far = near_far_search(test_output, embedding_array, 10, 10, metric)
+    else:
+        neigh = load_index(index, embedding_array, train_image_name, 10, metric = metric, gallery_path = gallery_path)
+        if index == 'ivf':
+            neigh.nprobe = nprobe
+        elif index == 'pq':
+            neigh.rerank = rerank
+        predict_out = neigh.kneighbors(test_output, 10)
+        report_recall(embedding_array, train_image_name, test_output, predict_out[1], 10, len(test_output))
+        # the farthest matches always come from exact search over the whole gallery
+        _, predict_out_far = near_far_search(test_output, embedding_array, 0, 10, metric)
     top_ten = np.array(predict_out[1]).flatten()
     top_ten_dis = np.array(predict_out[0]).flatten()
-    predict_out_10 = neigh.kneighbors(test_output, n_neighbors=100000)
-    bottom_ten = np.array(predict_out_10[1][:-10:-1]).flatten()
-    bottom_ten_dis = np.array(predict_out_10[0][:-10:-1]).flatten()
+    bottom_ten = np.array(predict_out_far[1]).flatten()
+    bottom_ten_dis = np.array(predict_out_far[0]).flatten()
 
     print("finish predict", time.time() - time_fit)
     with open('testname_list.pkl', 'wb') as f:
@@ -213,4 +266,39 @@ def validate(embedding_array,train_image_name):
         pickle.dump(bottom_ten_dis, f)
 
 
-validate('embedding.pkl', 'train_image_name.pkl')
+
+def main(argv):
+    # python test.py runs validate() as before, --test runs the full retrieval evaluation
+    run = validate
+    embedding_array, train_image_name = 'embedding.pkl', 'train_image_name.pkl'
+    kwargs = {}
+    try:
+        opts, args = getopt.getopt(argv, "", ["test", "embedding=", "names=", "index=", "nprobe=", "rerank=", "metric=", "amp=",
+                                              "quantized=", "k_reciprocal=", "packed=", "num_batches=", "recall_queries="])
+    except getopt.GetoptError:
+        print('test.py --test --embedding=embedding.pkl --names=train_image_name.pkl --index=exact|torch|ivf|pq --nprobe=8 --rerank=0 '
+              '--metric=l2|cosine --amp=bf16|fp16 --quantized=model_int8.pt --k_reciprocal=0 --packed=tiny_packed '
+              '--num_batches=1 --recall_queries=1000')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "--test":
+            run = test
+        elif opt == "--embedding":
+            embedding_array = arg
+        elif opt == "--names":
+            train_image_name = arg
+        elif opt in ("--index", "--metric", "--amp", "--quantized", "--packed"):
+            kwargs[opt[2:]] = arg
+        elif opt in ("--nprobe", "--rerank", "--k_reciprocal", "--num_batches", "--recall_queries"):
+            kwargs[opt[2:]] = int(arg)
+    if run is validate and ('k_reciprocal' in kwargs or 'recall_queries' in kwargs):
+        print('--k_reciprocal and --recall_queries need --test')
+        sys.exit(2)
+    if run is test and 'num_batches' in kwargs:
+        print('--num_batches is for validate, --test evaluates every query')
+        sys.exit(2)
+    run(embedding_array, train_image_name, **kwargs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,50 @@
+import numpy as np
+from sampler import ClassIndex, PKBatchSampler
+
+
+def make_index(counts):
+    names = ['%d.JPEG' % i for i in range(sum(counts))]
+    return ClassIndex(names, counts, ['n%03d' % c for c in range(len(counts))])
+
+
+def check_batches(index, p, k, seed = 0, epoch = 0, world_size = 1):
+    seen = []
+    for rank in range(world_size):
+        sampler = PKBatchSampler(index, p, k, seed = seed, rank = rank, world_size = world_size)
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        for batch in batches:
+            labels, sizes = np.unique(index.label_ids[batch], return_counts = True)
+            # exactly p distinct classes, k images each
+            assert len(labels) == p, index.label_ids[batch]
+            assert (sizes == k).all(), index.label_ids[batch]
+            seen.extend(batch)
+    # no image twice in an epoch, across all ranks
+    assert len(seen) == len(set(seen))
+
+
+def test_uneven_classes():
+    # [10, 7, 5] with p = 2, k = 3 used to give a batch of six images of class 0
+    index = make_index([10, 7, 5])
+    for epoch in range(20):
+        check_batches(index, 2, 3, epoch = epoch)
+    assert len(PKBatchSampler(index, 2, 3)) == 2
+
+
+def test_random_counts():
+    rng = np.random.RandomState(0)
+    for trial in range(50):
+        index = make_index(rng.randint(1, 30, rng.randint(2, 12)).tolist())
+        p = rng.randint(2, len(index.classes) + 1)
+        k = rng.randint(1, 5)
+        check_batches(index, p, k, seed = trial, epoch = trial, world_size = rng.randint(1, 4))
+
+
+def test_reproducible():
+    index = make_index([12, 9, 9, 4, 7])
+    first = list(PKBatchSampler(index, 3, 2, seed = 1))
+    assert first == list(PKBatchSampler(index, 3, 2, seed = 1))
+    sampler = PKBatchSampler(index, 3, 2, seed = 1)
+    sampler.set_epoch(1)
+    assert first != list(sampler)
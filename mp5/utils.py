@@ -2,60 +2,56 @@ import os
 import sys
 import time
 import math
+import shutil
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import json
 
-_, term_width = os.popen('stty size', 'r').read().split()
-term_width = int(term_width)
+TOTAL_BAR_LENGTH = 60
+REDRAW_INTERVAL = 0.1  # seconds between two redraws of the bar on a terminal
+LOG_INTERVAL = 10.     # seconds between two plain lines when stdout is not a terminal
 
-TOTAL_BAR_LENGTH = 60.
+# looked up when a bar starts, not at import: batch jobs have no terminal to ask
+tty = None
+term_width = 80
 last_time = time.time()
 begin_time = last_time
+last_step = 0
 def progress_bar(current, total, msg=None):
-    global last_time, begin_time
-    if current == 0:
-        begin_time = time.time()  # Reset for new bar.
-
-    cur_len = int(TOTAL_BAR_LENGTH*current/total)
-    rest_len = int(TOTAL_BAR_LENGTH - cur_len) - 1
-
-    sys.stdout.write(' [')
-    for i in range(cur_len):
-        sys.stdout.write('=')
-    sys.stdout.write('>')
-    for i in range(rest_len):
-        sys.stdout.write('.')
-    sys.stdout.write(']')
-
+    '''
+    on a terminal one bar line is redrawn in place, at most every REDRAW_INTERVAL seconds;
+    otherwise (log files, batch nodes) a plain line is printed every LOG_INTERVAL seconds.
+    the last step is always shown. each update is built as one string and written once
+    '''
+    global tty, term_width, last_time, begin_time, last_step
     cur_time = time.time()
-    step_time = cur_time - last_time
+    if current == 0 or tty is None:
+        # Reset for new bar.
+        tty = sys.stdout.isatty()
+        term_width = shutil.get_terminal_size((80, 20)).columns
+        begin_time = last_time = cur_time
+        last_step = current
+    done = current >= total - 1
+    if not done and cur_time - last_time < (REDRAW_INTERVAL if tty else LOG_INTERVAL):
+        return
+
+    step_time = (cur_time - last_time) / max(current - last_step, 1)
     last_time = cur_time
+    last_step = current
     tot_time = cur_time - begin_time
-    est_time = (step_time * total) - tot_time 
+    est_time = tot_time / (current + 1) * (total - current - 1)
 
-    L = []
-    L.append('  Step: %s' % format_time(step_time))
-    L.append(' | Tot: %s' % format_time(tot_time))
-    L.append(' | Est: %s' % format_time(est_time))
+    info = '  Step: %s | Tot: %s | Est: %s' % (format_time(step_time), format_time(tot_time), format_time(est_time))
     if msg:
-        L.append(' | ' + msg)
-
-    msg = ''.join(L)
-    sys.stdout.write(msg)
-    for i in range(term_width-int(TOTAL_BAR_LENGTH)-len(msg)-3):
-        sys.stdout.write(' ')
-
-    # Go back to the center of the bar.
-    for i in range(term_width-int(TOTAL_BAR_LENGTH/2)+2):
-        sys.stdout.write('\b')
-    sys.stdout.write(' %d/%d ' % (current+1, total))
-
-    if current < total-1:
-        sys.stdout.write('\r')
+        info += ' | ' + msg
+    if tty:
+        cur_len = int(TOTAL_BAR_LENGTH*current/total)
+        bar = ' [' + '=' * cur_len + '>' + '.' * (TOTAL_BAR_LENGTH - cur_len - 1) + ']'
+        line = (bar + ' %d/%d' % (current+1, total) + info)[:term_width - 1]
+        sys.stdout.write('\r' + line.ljust(term_width - 1) + ('\n' if done else ''))
     else:
-        sys.stdout.write('\n')
+        sys.stdout.write('%d/%d' % (current+1, total) + info + '\n')
     sys.stdout.flush()
 
 def format_time(seconds):